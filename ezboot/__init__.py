@@ -16,21 +16,44 @@ For example:
 
 """
 import argparse
+import BaseHTTPServer
+import calendar
 import ConfigParser
-from contextlib import contextmanager
+from contextlib import closing, contextmanager
+import ctypes
+import ctypes.util
+from email.utils import parsedate
+from collections import OrderedDict
 from getpass import getpass
+import gzip
+import hashlib
+import json
+import math
 import netifaces
 import os
+import pipes
+import platform
 import pprint
+import Queue
+import re
+import select as select_module
 import socket
 import shutil
+import struct
+import SocketServer
+import ssl
 import subprocess
 from subprocess import check_call, check_output
 import sys
+import tarfile
 import tempfile
+import threading
 import time
 import traceback
+import urlparse
 import xml.etree.ElementTree as ET
+import zipfile
+import zlib
 
 from gaiatest import GaiaDevice, GaiaApps, GaiaData, LockScreen
 from gaiatest.apps.browser.app import Browser
@@ -42,7 +65,23 @@ import requests
 from requests.auth import HTTPBasicAuth
 
 CHUNK_SIZE = 1024 * 13
+DOWNLOAD_BUFFER_SIZE = 1024 * 256
 TERM_WIDTH = 65  # number of terminal columns for progress indicator
+DEFAULT_BUILD_URLS = {
+    'unagi': ('https://pvtbuilds.mozilla.org/pub/mozilla.org/b2g/nightly/'
+              'mozilla-aurora-unagi-eng/latest/unagi.zip'),
+    'inari': ('https://pvtbuilds.mozilla.org/pvt/mozilla.org/b2gotoro/nightly/'
+              'mozilla-aurora-inari-eng/latest/inari.zip'),
+}
+# Commands that drive the device UI through Marionette; a plan never runs
+# two of these at the same time.
+MARIONETTE_COMMANDS = ('setup', 'install', 'install_mkt', 'login', 'kill',
+                       'recss', 'sync', 'bench-fps', 'bench-boot', 'bind')
+# Commands that leave the device rebooting when they finish; a plan runs
+# these with nothing else using the device.
+REBOOT_COMMANDS = ('flash', 'reflash', 'mkt_certs', 'restore', 'bench-boot')
+# Commands that don't touch the device at all.
+HOST_COMMANDS = ('desktop', 'dl', 'info', 'prefetch', 'proxy', 'serve')
 
 
 def user_agrees(prompt='OK? Y/N [%s]: ', default='Y',
@@ -100,6 +139,87 @@ def sh_output(cmd):
     return check_output(cmd, shell=True)
 
 
+def adb_shell(cmd):
+    """Runs cmd in an adb shell and returns (output, exit status).
+
+    adb shell does not pass the exit status of the remote command through
+    so we echo it at the end of the output.
+    """
+    out = sh_output('adb shell %s'
+                    % pipes.quote('%s; echo "ezboot-rc=$?"' % cmd))
+    out, _, rc = out.replace('\r\n', '\n').rpartition('ezboot-rc=')
+    return out, int(rc.strip() or 1)
+
+
+def as_list(value):
+    """Returns an option's value as a list.
+
+    The config file gives a string when a list option has a single value.
+    """
+    if value is None:
+        return []
+    if isinstance(value, basestring):
+        return [value]
+    return list(value)
+
+
+def run_per_device(fn, device_ids):
+    """Calls fn(device_id) for all devices at once.
+
+    Returns (device_id, exception) for each device where a command failed.
+    """
+    errors = []
+
+    def run(device_id):
+        try:
+            fn(device_id)
+        except subprocess.CalledProcessError, exc:
+            errors.append((device_id, exc))
+
+    threads = [threading.Thread(target=run, args=(device_id,))
+               for device_id in device_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+LS_RE = re.compile(r'^([-dl])([-rwxsStT]{9})\s+(\S+)\s+(\S+)\s+(?:(\d+)\s+)?'
+                   r'(\d{4}-\d\d-\d\d \d\d:\d\d) (.+)$')
+
+
+def device_ls(root):
+    """Yields (path, type, perms, owner, group, size, mtime) for everything
+    beneath root on the device.
+
+    type is the first letter of the ls mode; size is None for directories.
+    """
+    out, rc = adb_shell('ls -lR %s' % pipes.quote(root))
+    if rc != 0:
+        raise ValueError('Could not list %s: %s' % (root, out.strip()))
+    parent = root.rstrip('/')
+    for line in out.splitlines():
+        if line.startswith('/') and line.endswith(':'):
+            parent = line[:-1].rstrip('/')
+            continue
+        match = LS_RE.match(line)
+        if match:
+            kind, perms, owner, group, size, mtime, name = match.groups()
+            if kind == 'l':
+                name = name.split(' -> ')[0]
+            yield ('%s/%s' % (parent, name), kind, perms, owner, group,
+                   int(size) if size else None, mtime)
+
+
+def md5_file(path):
+    digest = hashlib.md5()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE * 10), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def wait_for_element_displayed(mc, by, locator, timeout=10):
     timeout = float(timeout) + time.time()
 
@@ -163,6 +283,165 @@ def wait_for_condition(mc, method, timeout=10,
         raise TimeoutException(message)
 
 
+# Runs a list of locate/wait/act steps in the current frame in a single
+# Marionette round trip. Steps that wait poll until they succeed or time out.
+BATCH_JS = """
+var steps = arguments[0];
+var now = window.performance ? function() { return performance.now(); }
+                             : function() { return Date.now(); };
+var start = now(), results = [];
+
+function find(by, value) {
+    switch (by) {
+        case 'id':
+            return document.getElementById(value);
+        case 'css selector':
+            return document.querySelector(value);
+        case 'class name':
+            return document.getElementsByClassName(value)[0] || null;
+        case 'tag name':
+            return document.getElementsByTagName(value)[0] || null;
+        case 'name':
+            return document.getElementsByName(value)[0] || null;
+    }
+    throw new Error('Unsupported locator strategy: ' + by);
+}
+
+function displayed(el) {
+    if (!el) {
+        return false;
+    }
+    var rect = el.getBoundingClientRect();
+    var style = window.getComputedStyle(el);
+    return rect.width > 0 && rect.height > 0 &&
+           style.visibility != 'hidden' && style.display != 'none';
+}
+
+// Returns undefined while a step should be retried.
+function perform(step) {
+    var el, i;
+    switch (step.op) {
+        case 'wait_present':
+            return find(step.by, step.value) ? true : undefined;
+        case 'wait_displayed':
+            return displayed(find(step.by, step.value)) ? true : undefined;
+        case 'wait_not_displayed':
+            return displayed(find(step.by, step.value)) ? undefined : true;
+        case 'wait_any':
+            for (i = 0; i < step.locators.length; i++) {
+                if (displayed(find(step.locators[i][0],
+                                   step.locators[i][1]))) {
+                    return i;
+                }
+            }
+            return undefined;
+        case 'is_displayed':
+            return displayed(find(step.by, step.value));
+        case 'send_keys':
+            el = find(step.by, step.value);
+            if (!el) {
+                return undefined;
+            }
+            el.focus();
+            el.value += step.text;
+            ['keyup', 'input', 'change'].forEach(function(type) {
+                el.dispatchEvent(new Event(type, {bubbles: true}));
+            });
+            return true;
+        case 'tap':
+            el = find(step.by, step.value);
+            if (!displayed(el)) {
+                return undefined;
+            }
+            el.click();
+            return true;
+    }
+    throw new Error('Unsupported step: ' + step.op);
+}
+
+function finish(error, index) {
+    marionetteScriptFinished({error: error, failed: index, steps: results,
+                              ms: now() - start});
+}
+
+function run(i) {
+    if (i == steps.length) {
+        return finish(null, null);
+    }
+    var step = steps[i], stepStart = now();
+    function attempt() {
+        var value;
+        try {
+            value = perform(step);
+        } catch (e) {
+            return finish(e.message || String(e), i);
+        }
+        if (value === undefined) {
+            if (now() - stepStart > step.timeout) {
+                return finish('Timed out waiting for ' + step.op + ' ' +
+                              (step.value || JSON.stringify(step.locators)),
+                              i);
+            }
+            return setTimeout(attempt, 100);
+        }
+        results.push({op: step.op, ms: now() - stepStart, value: value});
+        run(i + 1);
+    }
+    attempt();
+}
+run(0);
+"""
+
+
+class BatchResult(object):
+    """The outcome of run_batch().
+
+    steps is a list of dicts with the op, the time it took in ms and its
+    value, such as the index of the locator that appeared for wait_any.
+    """
+
+    def __init__(self, result):
+        self.steps = result['steps']
+        self.ms = result['ms']
+        self.error = result['error']
+        self.failed = result['failed']
+
+    @property
+    def values(self):
+        return [step['value'] for step in self.steps]
+
+
+def run_batch(mc, steps, timeout=10):
+    """Runs UI steps in the current frame with one Marionette call.
+
+    Each step is a tuple of (op, locator) plus the text for send_keys. For
+    wait_any the locator is a list of locators. Ops are wait_present,
+    wait_displayed, wait_not_displayed, wait_any, is_displayed, send_keys
+    and tap. Every step except is_displayed retries until its element is
+    ready, for up to timeout seconds, and then raises TimeoutException just
+    like the wait_for_* helpers.
+    """
+    script_steps = []
+    for step in steps:
+        op, locator = step[0], step[1]
+        data = {'op': op, 'timeout': timeout * 1000}
+        if op == 'wait_any':
+            data['locators'] = locator
+        else:
+            data['by'], data['value'] = locator
+        if op == 'send_keys':
+            data['text'] = step[2]
+        script_steps.append(data)
+
+    mc.set_script_timeout((timeout * len(steps) + 5) * 1000)
+    result = BatchResult(mc.execute_async_script(BATCH_JS,
+                                                 script_args=[script_steps]))
+    if result.error:
+        raise TimeoutException('Step %s failed: %s'
+                               % (result.failed + 1, result.error))
+    return result
+
+
 def get_installed(apps):
     apps.marionette.switch_to_frame()
     res = apps.marionette.execute_async_script("""
@@ -198,6 +477,210 @@ def get_marionette(args):
     return mc
 
 
+DEVICE_PREFS = '/data/local/user.js'
+PREF_RE = re.compile(r"""^\s*(?:user_)?pref\(\s*("[^"]*"|'[^']*')\s*,"""
+                     r"""\s*(.+?)\s*\)\s*;""", re.M)
+# Prefs that Gecko only reads at startup.
+RESTART_PREFS = ('dom.ipc.', 'layers.', 'gfx.', 'marionette.',
+                 'devtools.debugger.', 'browser.startup.')
+# Runs in chrome context. Returns the names of prefs that could not be set
+# at runtime, such as when the type of an existing pref changed.
+APPLY_PREFS_JS = """
+Components.utils.import('resource://gre/modules/Services.jsm');
+var prefs = arguments[0], cleared = arguments[1], failed = [];
+for (var name in prefs) {
+    var value = prefs[name];
+    try {
+        if (typeof value == 'boolean') {
+            Services.prefs.setBoolPref(name, value);
+        } else if (typeof value == 'number') {
+            Services.prefs.setIntPref(name, value);
+        } else {
+            Services.prefs.setCharPref(name, value);
+        }
+    } catch (e) {
+        failed.push(name);
+    }
+}
+cleared.forEach(function(name) {
+    Services.prefs.clearUserPref(name);
+});
+return failed;
+"""
+
+
+def parse_prefs(text):
+    """Returns a dict of pref name -> value from a prefs.js style file."""
+    prefs = {}
+    for match in PREF_RE.finditer(text):
+        name, value = match.group(1)[1:-1], match.group(2)
+        if value in ('true', 'false'):
+            value = value == 'true'
+        elif re.match(r'^-?\d+$', value):
+            value = int(value)
+        elif value[0] == value[-1] and value[0] in '"\'':
+            value = value[1:-1].decode('string_escape')
+        prefs[name] = value
+    return prefs
+
+
+def apply_prefs(args, prefs, cleared=()):
+    """Sets prefs in the running b2g process.
+
+    Returns a list of pref names that could not be changed without a
+    restart.
+    """
+    mc = get_marionette(args)
+    mc.set_context(mc.CONTEXT_CHROME)
+    try:
+        return mc.execute_script(APPLY_PREFS_JS,
+                                 script_args=[prefs, list(cleared)])
+    finally:
+        mc.set_context(mc.CONTEXT_CONTENT)
+        mc.client.close()
+
+
+WPA_SUPPLICANT_CONF = '/data/misc/wifi/wpa_supplicant.conf'
+DEVICE_SETTINGS = '/system/b2g/defaults/settings.json'
+
+
+def get_wifi_pass_key(args):
+    """Validates the WiFi options and returns the Gaia password field."""
+    if not args.wifi_key or not args.wifi_pass:
+        args.error('Missing --wifi_key or --wifi_pass option')
+    args.wifi_key = args.wifi_key.upper()
+    if args.wifi_key == 'WPA-PSK':
+        return 'psk'
+    elif args.wifi_key == 'WEP':
+        return 'wep'
+    else:
+        args.error('not sure what key to use for %r' % args.wifi_key)
+
+
+def wpa_quote(value):
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def preseed_wifi(args):
+    """Writes the WiFi network config while b2g is stopped.
+
+    This lets a freshly flashed device associate as soon as it boots
+    instead of waiting for setup to drive the Settings UI.
+    """
+    pass_key = get_wifi_pass_key(args)
+    network = ['ssid=%s' % wpa_quote(args.wifi_ssid)]
+    if pass_key == 'psk':
+        network += ['key_mgmt=WPA-PSK', 'psk=%s' % wpa_quote(args.wifi_pass)]
+    else:
+        network += ['key_mgmt=NONE', 'wep_key0=%s' % wpa_quote(args.wifi_pass),
+                    'wep_tx_keyidx=0']
+    conf = ('ctrl_interface=wlan0\n'
+            'update_config=1\n'
+            'network={\n%s\n}\n' % '\n'.join('\t' + ln for ln in network))
+
+    print 'Preseeding WiFi for %s' % args.wifi_ssid
+    sh('adb wait-for-device')
+    sh('adb shell stop b2g')
+    td = tempfile.mkdtemp()
+    try:
+        with pushd(td):
+            with open('wpa_supplicant.conf', 'w') as fp:
+                fp.write(conf)
+            sh('adb push wpa_supplicant.conf %s' % WPA_SUPPLICANT_CONF)
+            sh('adb shell chown system.wifi %s' % WPA_SUPPLICANT_CONF)
+            sh('adb shell chmod 660 %s' % WPA_SUPPLICANT_CONF)
+
+            # The settings database is created from these defaults the
+            # first time b2g starts after a flash.
+            sh('adb remount')
+            sh('adb pull %s ./settings.json' % DEVICE_SETTINGS)
+            with open('settings.json') as fp:
+                settings = json.load(fp)
+            if settings.get('wifi.enabled') is not True:
+                settings['wifi.enabled'] = True
+                with open('settings.json', 'w') as fp:
+                    json.dump(settings, fp, indent=2)
+                sh('adb push settings.json %s' % DEVICE_SETTINGS)
+    finally:
+        shutil.rmtree(td)
+        sh('adb shell start b2g')
+        print 'Your device is rebooting.'
+
+
+def set_proxy_prefs(args):
+    host, _, port = args.proxy.rpartition(':')
+    if not host or not port.isdigit():
+        args.error('--proxy should look like HOST:PORT')
+    port = int(port)
+    apply_prefs(args, {'network.proxy.type': 1,
+                       'network.proxy.http': host,
+                       'network.proxy.http_port': port,
+                       'network.proxy.ssl': host,
+                       'network.proxy.ssl_port': port})
+    print 'Routing device traffic through %s until b2g restarts' % args.proxy
+
+
+def install_proxy_ca(args):
+    """Adds the ezboot proxy CA to the b2g profile's certificate database.
+
+    Without it the device rejects the certificates that
+    ezboot proxy --intercept_https makes up for HTTPS hosts.
+    """
+    ca_cert = args.proxy_ca or os.path.join(args.work_dir, 'proxy-ca',
+                                            'ca.pem')
+    if not os.path.exists(ca_cert):
+        if args.proxy_ca:
+            args.error('Proxy CA not found: %s' % args.proxy_ca)
+        print (' ** No proxy CA at %s; HTTPS will not be cached. Run '
+               'ezboot proxy --intercept_https to create one.' % ca_cert)
+        return
+    if not find_executable('certutil'):
+        args.error('certutil is needed to install the proxy CA. It comes '
+                   'with NSS (libnss3-tools on Debian/Ubuntu).')
+
+    profile = sh_output('adb shell ls -d /data/b2g/mozilla/*.default')
+    profile = profile.strip().splitlines()[0].strip()
+    files = sh_output('adb shell ls %s' % profile).split()
+    if 'cert9.db' in files:
+        db_files = ('cert9.db', 'key4.db', 'pkcs11.txt')
+        db = 'sql:.'
+    else:
+        db_files = ('cert8.db', 'key3.db', 'secmod.db')
+        db = 'dbm:.'
+
+    td = tempfile.mkdtemp()
+    try:
+        with pushd(td):
+            for name in db_files:
+                if name in files:
+                    sh('adb pull %s/%s %s' % (profile, name, name))
+            with open(os.devnull, 'w') as devnull:
+                try:
+                    current = check_output(['certutil', '-d', db, '-L', '-n',
+                                            PROXY_CA_NAME, '-a'],
+                                           stderr=devnull)
+                except subprocess.CalledProcessError:
+                    current = None
+            if current is not None:
+                with open(ca_cert) as fp:
+                    if current.split() == fp.read().split():
+                        print 'Proxy CA is already installed'
+                        return
+                check_call(['certutil', '-d', db, '-D', '-n', PROXY_CA_NAME])
+            print 'Installing proxy CA %s' % ca_cert
+            check_call(['certutil', '-d', db, '-A', '-n', PROXY_CA_NAME,
+                        '-t', 'C,,', '-i', ca_cert])
+            sh('adb shell stop b2g')
+            try:
+                for name in db_files:
+                    sh('adb push %s %s/%s' % (name, profile, name))
+            finally:
+                sh('adb shell start b2g')
+                print 'Your device is rebooting.'
+    finally:
+        shutil.rmtree(td)
+
+
 def set_up_device(args):
     def install_apps():
         mc = get_marionette(args)
@@ -217,26 +700,24 @@ def set_up_device(args):
 
         if args.wifi_ssid:
             print 'Configuring WiFi'
-            if not args.wifi_key or not args.wifi_pass:
-                args.error('Missing --wifi_key or --wifi_pass option')
-            args.wifi_key = args.wifi_key.upper()
+            pass_key = get_wifi_pass_key(args)
 
             data_layer = GaiaData(mc)
             data_layer.enable_wifi()
-            if args.wifi_key == 'WPA-PSK':
-                pass_key = 'psk'
-            elif args.wifi_key == 'WEP':
-                pass_key = 'wep'
-            else:
-                args.error('not sure what key to use for %r' % args.wifi_key)
-
             data = {'ssid': args.wifi_ssid, 'keyManagement': args.wifi_key,
                     pass_key: args.wifi_pass}
-            data_layer.connect_to_wifi(data)
+            if data_layer.is_wifi_connected(data):
+                # It was probably preseeded when flashing.
+                print 'WiFi is already connected'
+            else:
+                data_layer.connect_to_wifi(data)
 
         # disconnect marionette client because install_app would need it
         mc.client.close()
 
+        if args.proxy:
+            set_proxy_prefs(args)
+
         # install apps one by one
         for manifest in args.apps:
             args.manifest = manifest
@@ -244,16 +725,51 @@ def set_up_device(args):
             install_app(args)
 
     def push_custom_prefs():
+        with open(args.custom_prefs) as fp:
+            local = fp.read()
+        device, rc = adb_shell('cat %s' % DEVICE_PREFS)
+        if rc != 0:
+            device = ''
+        if hashlib.md5(local).digest() == hashlib.md5(device).digest():
+            print 'Custom prefs on the device are up to date'
+            return
+
         print 'Pushing custom prefs from %s' % args.custom_prefs
+        old = parse_prefs(device)
+        new = parse_prefs(local)
+        changed = dict((k, v) for k, v in new.items() if old.get(k) != v)
+        cleared = [k for k in old if k not in new]
+        needs_restart = [k for k in changed.keys() + cleared
+                         if k.startswith(RESTART_PREFS)]
+
+        if not needs_restart:
+            sh('adb push "%s" %s' % (args.custom_prefs, DEVICE_PREFS))
+            try:
+                needs_restart = apply_prefs(args, changed, cleared)
+            except Exception, exc:
+                print ' ** could not apply prefs live: %s: %s' % (
+                    exc.__class__.__name__, exc)
+                needs_restart = changed.keys() + cleared
+            if not needs_restart:
+                print 'Applied %s changed pref(s) without restarting' % (
+                    len(changed) + len(cleared))
+                return
+
+        print 'Restarting for: %s' % ', '.join(sorted(needs_restart))
         sh('adb shell stop b2g')
         try:
-            sh('adb push "%s" /data/local/user.js' % args.custom_prefs)
+            sh('adb push "%s" %s' % (args.custom_prefs, DEVICE_PREFS))
         finally:
             sh('adb shell start b2g')
             print 'Your device is rebooting.'
 
+    if args.proxy:
+        install_proxy_ca(args)
+
     if args.apps is not None:
         install_apps()
+    elif args.proxy:
+        set_proxy_prefs(args)
 
     if args.custom_prefs and os.path.exists(args.custom_prefs):
         push_custom_prefs()
@@ -291,6 +807,102 @@ def get_interface_data(interface=None):
     return sorted(interface_ips, key=lambda tup: tup[1])
 
 
+# Requests every probe URL at once from the device and reports the round
+# trip time in milliseconds, or null if the URL was unreachable.
+PROBE_JS = """
+var urls = arguments[0], timeout = arguments[1];
+var results = {}, pending = urls.length;
+var now = window.performance ? function() { return performance.now(); }
+                             : function() { return Date.now(); };
+urls.forEach(function(url) {
+    var start = now();
+    var xhr = new XMLHttpRequest({mozSystem: true});
+    function done(ok) {
+        if (url in results) {
+            return;
+        }
+        results[url] = ok ? now() - start : null;
+        if (--pending == 0) {
+            marionetteScriptFinished(results);
+        }
+    }
+    xhr.open('GET', url, true);
+    xhr.timeout = timeout;
+    xhr.onload = function() { done(xhr.status == 200); };
+    xhr.onerror = xhr.ontimeout = function() { done(false); };
+    xhr.send();
+});
+"""
+
+
+class ProbeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+
+def probe_interfaces(args, interface_ips, timeout=3):
+    """Checks which host IPs the device can reach.
+
+    A temporary HTTP listener is started on each IP and the device requests
+    all of them concurrently. Returns a list of (rtt_ms, interface, ip)
+    sorted by fastest first; rtt_ms is None for unreachable IPs.
+    """
+    servers = {}
+    try:
+        for interface, ip in interface_ips:
+            try:
+                server = BaseHTTPServer.HTTPServer((ip, 0), ProbeHandler)
+            except socket.error, exc:
+                print ' ** cannot listen on %s: %s' % (ip, exc)
+                continue
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            url = 'http://%s:%s/ezboot-probe' % (ip, server.server_port)
+            servers[url] = (interface, ip, server)
+
+        mc = get_marionette(args)
+        mc.switch_to_frame()
+        mc.set_script_timeout((timeout + 5) * 1000)
+        rtts = mc.execute_async_script(PROBE_JS, script_args=[
+            servers.keys(), timeout * 1000])
+        mc.client.close()
+    finally:
+        for interface, ip, server in servers.values():
+            server.shutdown()
+            server.server_close()
+
+    results = [(rtts.get(probe_url), interface, ip)
+               for probe_url, (interface, ip, server) in servers.items()]
+    # Unreachable (None) sorts last.
+    return sorted(results, key=lambda r: (r[0] is None, r[0]))
+
+
+def guess_reachable_ip(args, interfaces):
+    """Returns the fastest IP the device can reach or None."""
+    print 'Checking which IP your device can reach...'
+    try:
+        results = probe_interfaces(args, interfaces,
+                                   timeout=args.probe_timeout)
+    except Exception, exc:
+        print ' ** could not probe from the device: %s: %s' % (
+            exc.__class__.__name__, exc)
+        return None
+    for rtt, interface, ip_addr in results:
+        print '  %s (%s): %s' % (
+            ip_addr, interface,
+            'unreachable' if rtt is None else '%.1fms' % rtt)
+    if results and results[0][0] is not None:
+        return results[0][2]
+
+
 def do_bind(args):
     if args.show_net:
         interface_ips = get_interface_data()
@@ -305,7 +917,17 @@ def do_bind(args):
         if not interfaces:
             args.error('No useable interfaces found. Are you connected '
                        'to a network that your device will be able to "see"?')
-        if len(interfaces) > 1:
+        if len(interfaces) == 1:
+            # Get the only ip we found.
+            args.bind_ip = interfaces[0][1]
+        else:
+            args.bind_ip = guess_reachable_ip(args, interfaces)
+
+        if not args.bind_ip and not sys.stdin.isatty():
+            # Such as a plan step.
+            args.error('Could not tell which IP the device can reach. '
+                       'Use --bind_ip or --bind_int.')
+        if not args.bind_ip:
             prompt = 'Not sure which IP to use. Please select one [1]:'
             interface_ips = get_interface_data()
             choices = []
@@ -314,9 +936,6 @@ def do_bind(args):
 
             choice = select(choices, prompt=prompt)
             args.bind_ip = choice[1]
-        else:
-            # Get the only ip we found.
-            args.bind_ip = interfaces[0][1]
 
     print 'About to bind host "{host}" on device to IP "{ip}"'.format(
             host=args.bind_host, ip=args.bind_ip)
@@ -380,14 +999,445 @@ SHELL
     sh('adb reboot')
 
 
-def flash_device(args):
-    default_build_urls = {
-        'unagi': ('https://pvtbuilds.mozilla.org/pub/mozilla.org/b2g/nightly/'
-                  'mozilla-aurora-unagi-eng/latest/unagi.zip'),
-        'inari': ('https://pvtbuilds.mozilla.org/pvt/mozilla.org/b2gotoro/nightly/'
-                  'mozilla-aurora-inari-eng/latest/inari.zip'),
-    }
+LOGCAT_RE = re.compile(r'^(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)\.(\d+)\s+'
+                       r'(\d+)\s+\d+\s+([VDIWEF])\s+(.*?)\s*: ')
+LOGCAT_LEVELS = 'VDIWEF'
+LOGCAT_FLUSH_INTERVAL = 10  # seconds before captured lines can be queried
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+class LogcatParser(object):
+    """Parses `adb logcat -v threadtime` lines.
 
+    logcat leaves out the year so each line is placed in the year that
+    puts it closest to the near timestamp.
+    """
+
+    def __init__(self, near):
+        self.near = near
+        self._minute = None
+        self._minute_start = None
+
+    def parse(self, line):
+        """Returns (time, pid, level, tag) or None for other lines."""
+        match = LOGCAT_RE.match(line)
+        if not match:
+            return None
+        minute = match.group(1, 2, 3, 4)
+        if minute != self._minute:
+            # Lines arrive in order so this runs about once a minute.
+            month, day, hour, mins = map(int, minute)
+            year = time.localtime(self.near).tm_year
+            starts = [time.mktime((y, month, day, hour, mins, 0, 0, 0, -1))
+                      for y in (year - 1, year, year + 1)]
+            self._minute = minute
+            self._minute_start = min(starts,
+                                     key=lambda t: abs(t - self.near))
+        second, ms, pid, level, tag = match.group(5, 6, 7, 8, 9)
+        return (self._minute_start + int(second) + int(ms) / 1000.0,
+                int(pid), level, tag)
+
+
+class LogSegment(object):
+    """A gzipped piece of captured logcat output and its index."""
+
+    def __init__(self, log_dir):
+        name = 'logcat-%d' % (time.time() * 1000)
+        self.path = os.path.join(log_dir, '%s.log.gz' % name)
+        self.index_path = os.path.join(log_dir, '%s.json' % name)
+        self.fp = gzip.open(self.path, 'wb')
+        self.size = 0
+        self.pids = set()
+        self.index = {'log': os.path.basename(self.path), 'start': None,
+                      'end': None, 'lines': 0, 'tags': {}, 'pids': []}
+
+    def write(self, line, parsed):
+        self.fp.write(line)
+        self.size += len(line)
+        self.index['lines'] += 1
+        if parsed:
+            ts, pid, level, tag = parsed
+            if self.index['start'] is None:
+                self.index['start'] = ts
+            self.index['start'] = min(self.index['start'], ts)
+            self.index['end'] = max(self.index['end'], ts)
+            self.index['tags'][tag] = self.index['tags'].get(tag, 0) + 1
+            self.pids.add(pid)
+
+    def save_index(self):
+        self.index['pids'] = sorted(self.pids)
+        tmp = '%s.tmp' % self.index_path
+        with open(tmp, 'w') as fp:
+            json.dump(self.index, fp)
+        os.rename(tmp, self.index_path)
+
+    def flush(self):
+        # A sync flush lets queries read everything written so far.
+        self.fp.flush()
+        self.save_index()
+
+    def close(self):
+        self.fp.close()
+        self.save_index()
+
+
+def logcat_segments(log_dir):
+    """Returns the index file paths of captured segments, oldest first."""
+    return sorted(os.path.join(log_dir, fn) for fn in os.listdir(log_dir)
+                  if fn.startswith('logcat-') and fn.endswith('.json'))
+
+
+def prune_logcat(log_dir, keep):
+    for index_path in logcat_segments(log_dir)[:-keep]:
+        os.unlink(index_path)
+        log = '%s.log.gz' % index_path[:-len('.json')]
+        if os.path.exists(log):
+            os.unlink(log)
+
+
+def capture_logcat(args, log_dir):
+    max_size = args.segment_size * 1024 * 1024
+    parser = LogcatParser(time.time())
+    segment = None
+    newest = 0
+    replaying = False
+    print 'Capturing logcat to %s (^C to quit)' % log_dir
+    try:
+        while True:
+            proc = subprocess.Popen(['adb', 'wait-for-device', 'logcat',
+                                     '-v', 'threadtime'],
+                                    stdout=subprocess.PIPE)
+            flushed = time.time()
+            # readline() instead of iterating so lines are not held back
+            # in a read-ahead buffer.
+            for line in iter(proc.stdout.readline, ''):
+                parsed = parser.parse(line)
+                if parsed:
+                    if replaying and parsed[0] < newest:
+                        # logcat dumps its whole buffer after reconnecting.
+                        continue
+                    replaying = False
+                    newest = max(newest, parsed[0])
+                if segment is None or segment.size >= max_size:
+                    if segment:
+                        segment.close()
+                        prune_logcat(log_dir, args.keep_segments)
+                    segment = LogSegment(log_dir)
+                segment.write(line, parsed)
+                if time.time() - flushed >= LOGCAT_FLUSH_INTERVAL:
+                    segment.flush()
+                    flushed = parser.near = time.time()
+            proc.wait()
+            if segment:
+                segment.flush()
+            print ' ** lost logcat (exit %s); waiting for the device' % (
+                proc.returncode)
+            replaying = True
+            time.sleep(1)
+    except KeyboardInterrupt:
+        print
+        if proc.poll() is None:
+            proc.terminate()
+    finally:
+        if segment:
+            segment.close()
+
+
+def parse_duration(value):
+    """Returns the seconds in a duration like 90, 30s, 10m, 2h or 1d."""
+    match = re.match(r'^(\d+)([smhd]?)$', value)
+    if not match:
+        raise ValueError('Not a duration: %s' % value)
+    return int(match.group(1)) * DURATION_UNITS[match.group(2) or 's']
+
+
+def parse_logcat_query(args, terms):
+    query = {}
+    for term in terms:
+        field, sep, value = term.partition('=')
+        if not sep or field not in ('tag', 'pid', 'level', 'text'):
+            args.error('Queries look like tag=Gecko, pid=123, level=W '
+                       'or text=error; got: %s' % term)
+        if field == 'pid':
+            if not value.isdigit():
+                args.error('Not a pid: %s' % value)
+            value = int(value)
+        elif field == 'level':
+            value = value.upper()[:1]
+            if not value or value not in LOGCAT_LEVELS:
+                args.error('level must be one of %s' % LOGCAT_LEVELS)
+        query[field] = value
+    return query
+
+
+def query_logcat(args, log_dir):
+    query = parse_logcat_query(args, args.query)
+    since = None
+    if args.since:
+        try:
+            since = time.time() - parse_duration(args.since)
+        except ValueError, exc:
+            args.error(str(exc))
+    min_level = LOGCAT_LEVELS.index(query.get('level', 'V'))
+
+    segments = logcat_segments(log_dir)
+    scanned = 0
+    for index_path in segments:
+        try:
+            with open(index_path) as fp:
+                index = json.load(fp)
+        except (IOError, ValueError):
+            # Pruned or being rewritten by a running capture.
+            continue
+        if index['start'] is None:
+            continue
+        if since and index['end'] < since:
+            continue
+        if 'tag' in query and query['tag'] not in index['tags']:
+            continue
+        if 'pid' in query and query['pid'] not in index['pids']:
+            continue
+        scanned += 1
+        parser = LogcatParser(index['start'])
+        log = os.path.join(log_dir, index['log'])
+        try:
+            with closing(gzip.open(log, 'rb')) as fp:
+                for line in fp:
+                    parsed = parser.parse(line)
+                    if not parsed:
+                        continue
+                    ts, pid, level, tag = parsed
+                    if ((since and ts < since) or
+                            query.get('tag', tag) != tag or
+                            query.get('pid', pid) != pid or
+                            LOGCAT_LEVELS.index(level) < min_level or
+                            query.get('text', '') not in line):
+                        continue
+                    sys.stdout.write(line)
+        except (IOError, EOFError):
+            # The segment being captured has no end marker yet.
+            pass
+    print >> sys.stderr, 'Searched %s of %s segment(s)' % (scanned,
+                                                            len(segments))
+
+
+def do_logcat(args):
+    log_dir = os.path.join(args.work_dir, 'logcat')
+    if not os.path.exists(log_dir):
+        os.mkdir(log_dir)
+    if args.capture:
+        capture_logcat(args, log_dir)
+    elif args.query is not None:
+        query_logcat(args, log_dir)
+    else:
+        args.error('Use --capture to record logs or --query to search them')
+
+
+MEMORY_TRIGGER = '/data/local/debug_info_trigger'
+MEMORY_REPORTS_DIR = '/data/local/tmp/memory-reports'
+MEMORY_PID_RE = re.compile(r'\s*\(pid \d+\)')
+MEMORY_ADDRESS_RE = re.compile(r'0x[0-9a-fA-F]+')
+JSON_SEPARATORS_RE = re.compile(r'[\s,]*')
+
+
+def b2g_pids():
+    """Returns the pids of the main b2g process and its children."""
+    rows = [line.split() for line in
+            sh_output('adb shell ps').splitlines()[1:]]
+    main = [row[1] for row in rows if row and row[-1] == '/system/b2g/b2g']
+    if not main:
+        return []
+    return main + [row[1] for row in rows if len(row) > 2 and
+                   row[2] == main[0]]
+
+
+def collect_memory_reports(args, dest):
+    """Asks every b2g process to dump a memory report and pulls them."""
+    pids = b2g_pids()
+    if not pids:
+        args.error('b2g is not running on the device')
+    adb_shell('rm -r %s' % MEMORY_REPORTS_DIR)
+    trigger = 'minimize memory report' if args.minimize else 'memory report'
+    print 'Dumping memory reports for %s b2g process(es)' % len(pids)
+    sh('adb shell %s' % pipes.quote('echo -n %s > %s' % (
+        pipes.quote(trigger), MEMORY_TRIGGER)))
+
+    # Reports are written as tmp-* and renamed when they are complete.
+    deadline = time.time() + args.report_timeout
+    while True:
+        out, rc = adb_shell('ls %s' % MEMORY_REPORTS_DIR)
+        reports = [fn for fn in out.split()
+                   if fn.startswith('memory-report-') and
+                   fn.endswith('.json.gz')] if rc == 0 else []
+        if len(reports) >= len(pids):
+            break
+        if time.time() > deadline:
+            print ' ** only %s of %s processes reported' % (len(reports),
+                                                            len(pids))
+            break
+        time.sleep(1)
+    if not reports:
+        args.error('No memory reports were written. Does this build '
+                   'support %s?' % MEMORY_TRIGGER)
+
+    paths = []
+    for fn in reports:
+        path = os.path.join(dest, fn)
+        sh('adb pull %s/%s %s' % (MEMORY_REPORTS_DIR, fn, pipes.quote(path)))
+        paths.append(path)
+    adb_shell('rm -r %s' % MEMORY_REPORTS_DIR)
+    return paths
+
+
+def iter_memory_reports(path):
+    """Yields each report in a gzipped about:memory dump.
+
+    Only a chunk of the file is held in memory at a time; reports are
+    decoded one by one from the "reports" array.
+    """
+    decoder = json.JSONDecoder()
+    with closing(gzip.open(path, 'rb')) as fp:
+        buf = ''
+        while True:
+            chunk = fp.read(DOWNLOAD_BUFFER_SIZE)
+            if not chunk:
+                return
+            buf += chunk
+            start = buf.find('"reports"')
+            if start != -1 and buf.find('[', start) != -1:
+                buf = buf[buf.find('[', start) + 1:]
+                break
+            # Keep enough to find the key if it straddles two chunks.
+            buf = buf[-len('"reports"'):]
+
+        pos = 0
+        while True:
+            pos = JSON_SEPARATORS_RE.match(buf, pos).end()
+            if buf[pos:pos + 1] == ']':
+                return
+            try:
+                report, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                chunk = fp.read(DOWNLOAD_BUFFER_SIZE)
+                if not chunk:
+                    raise ValueError('Truncated memory report: %s' % path)
+                buf = buf[pos:] + chunk
+                pos = 0
+                continue
+            yield report
+
+
+def summarize_memory_reports(paths):
+    """Returns {process: {path: bytes}} summed over all reports.
+
+    Process names lose their pid and paths lose object addresses so
+    that runs can be compared. Each explicit/ node also gets the total
+    of everything under it.
+    """
+    summary = {}
+    for path in paths:
+        for report in iter_memory_reports(path):
+            if report.get('units') != 0:  # only sizes in bytes
+                continue
+            process = MEMORY_PID_RE.sub('', report['process']) or 'Main'
+            name = MEMORY_ADDRESS_RE.sub('0x?', report['path'])
+            totals = summary.setdefault(process, {})
+            names = [name]
+            if name.startswith('explicit/'):
+                parts = name.split('/')
+                names += ['/'.join(parts[:i]) for i in range(1, len(parts))]
+            for key in names:
+                totals[key] = totals.get(key, 0) + report['amount']
+    return summary
+
+
+def find_memory_run(args, history, ref):
+    """Returns the newest run named ref or built from revision ref."""
+    for run in reversed(history):
+        if run['run'] == ref or any(rev.startswith(ref) for rev in
+                                    run['build'].values()):
+            return run
+    args.error('No memory run matches %s' % ref)
+
+
+def load_memory_run(args, run):
+    with open(os.path.join(args.work_dir, 'memory',
+                           '%s.json' % run['run'])) as fp:
+        return json.load(fp)
+
+
+def format_size(amount, sign=''):
+    for unit, size in (('MB', 1024 * 1024), ('KB', 1024)):
+        if abs(amount) >= size:
+            return ('%' + sign + '.2f%s') % (amount / float(size), unit)
+    return ('%' + sign + 'dB') % amount
+
+
+def print_memory_diff(before, after, top):
+    rows = []
+    for process in set(before) | set(after):
+        old, new = before.get(process, {}), after.get(process, {})
+        for name in set(old) | set(new):
+            change = new.get(name, 0) - old.get(name, 0)
+            rows.append((change, process, name, old.get(name, 0),
+                         new.get(name, 0)))
+
+    print 'explicit totals:'
+    for process in sorted(set(before) | set(after)):
+        old = before.get(process, {}).get('explicit', 0)
+        new = after.get(process, {}).get('explicit', 0)
+        print '  %-30s %10s -> %10s (%s)' % (
+            process[:30], format_size(old), format_size(new),
+            format_size(new - old, sign='+'))
+
+    print 'Largest growths:'
+    rows.sort(reverse=True)
+    for change, process, name, old, new in rows[:top]:
+        if change <= 0:
+            break
+        print '  %10s  %s: %s (%s -> %s)' % (
+            format_size(change, sign='+'), process, name,
+            format_size(old), format_size(new))
+
+
+def do_memory(args):
+    history = load_bench_results(args, 'memory')
+    if args.diff:
+        before = find_memory_run(args, history, args.diff[0])
+        after = find_memory_run(args, history, args.diff[1])
+    else:
+        build = build_revisions(args)
+        name = time.strftime('%Y%m%d-%H%M%S')
+        run_dir = os.path.join(args.work_dir, 'memory', name)
+        os.makedirs(run_dir)
+        try:
+            paths = collect_memory_reports(args, run_dir)
+            summary = summarize_memory_reports(paths)
+        finally:
+            if not args.keep_reports:
+                shutil.rmtree(run_dir)
+        with open('%s.json' % run_dir, 'w') as fp:
+            json.dump(summary, fp)
+        after = {'build': build, 'time': int(time.time()), 'run': name}
+        save_bench_result(args, 'memory', after)
+        print 'Saved memory run %s for %s' % (name, build_label(build))
+        if args.keep_reports:
+            print 'Reports are in %s' % run_dir
+
+        baseline = find_baseline(history, build, baseline=args.baseline)
+        if not baseline:
+            print 'No earlier build to compare with yet.'
+            return
+        before = baseline[-1]
+
+    print 'Comparing %s (%s) with %s (%s)' % (
+        before['run'], build_label(before['build']),
+        after['run'], build_label(after['build']))
+    print_memory_diff(load_memory_run(args, before),
+                      load_memory_run(args, after), args.top)
+
+
+def flash_device(args):
     if args.flash_device is None and args.flash_url is None:
         args.error('Try ezboot with flash with --flash_url or --flash_device '
                    'options. Or try ezboot flash --help for more details.')
@@ -395,8 +1445,8 @@ def flash_device(args):
         if args.flash_url:
             pass
         else:
-            if args.flash_device.lower() in default_build_urls.keys():
-                args.flash_url = default_build_urls[args.flash_device.lower()]
+            if args.flash_device.lower() in DEFAULT_BUILD_URLS.keys():
+                args.flash_url = DEFAULT_BUILD_URLS[args.flash_device.lower()]
             else:
                 prompt_msg = ('We don\'t have a URL to fetch latest build for '
                               'build for device "%s". Please provide a URL to '
@@ -416,11 +1466,30 @@ def download_and_save_build(args):
     print 'Your build is available at %s' % zipdest
 
 
+class ProgressReader(object):
+    """Wraps a file object to update a Progress as it is read."""
+
+    def __init__(self, fileobj, progress):
+        self.fileobj = fileobj
+        self.progress = progress
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if data:
+            self.progress.update(len(data))
+        return data
+
+
 @adb_not_required
 def install_desktop(args):
     if not args.platform:
         if sys.platform == 'darwin':
             args.platform = 'mac64'
+        elif sys.platform.startswith('linux'):
+            if platform.machine() == 'x86_64':
+                args.platform = 'linux-x86_64'
+            else:
+                args.platform = 'linux-i686'
         else:
             raise NotImplementedError(
                 "Sorry, I'm lazy. Please submit a patch for your "
@@ -432,109 +1501,1382 @@ def install_desktop(args):
             "That's odd, we don't have a URL for your platform. "
             "Guessed: args.%s" % attr)
 
-    print 'Downloading %s' % url
     dest = os.path.join(args.work_dir, 'last-desktop-build')
+    version_file = os.path.join(dest, '.ezboot-version')
+    installed = None
+    if os.path.exists(version_file):
+        with open(version_file) as fp:
+            installed = json.load(fp)
+
+    headers = {}
+    if installed and installed['url'] == url:
+        headers['If-None-Match'] = '"%s"' % installed['version']
+    res = requests.get(url, stream=True, headers=headers)
+    if (res.status_code == 304 or installed == {
+            'url': url, 'version': upstream_version(res)}):
+        res.close()
+        print 'The latest build from %s is already installed in %s' % (
+            url, dest)
+        return
+    if res.status_code != 200:
+        args.error('Got %s from %s. Try again later maybe'
+                   % (res.status_code, url))
+
+    print 'Downloading %s' % url
     if os.path.exists(dest):
         shutil.rmtree(dest)
     os.mkdir(dest)
 
     with pushd(dest):
-        # TODO: librarify this progress code.
-        res = requests.get(url, stream=True)
-        if res.status_code != 200:
-            args.error('Got %s from %s. Try again later maybe'
-                       % (res.status_code, url))
-        total_bytes = int(res.headers['content-length'])
-        filedest = open(os.path.basename(url), 'wb')
-        print 'Saving %s' % filedest.name
-        dots = 1
-        chars = ['.', ' ']
-        bytes_down = 0
-        width = TERM_WIDTH
-        with filedest as fp:
-            for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
-                bytes_down += CHUNK_SIZE
-                fp.write(chunk)
-                sys.stdout.write("\r%s%s %2.2f%%"
-                                 % (chars[0] * dots,
-                                    chars[1] * (width - dots),
-                                    100.0 * bytes_down / total_bytes))
-                sys.stdout.flush()
-                dots += 1
-                if dots >= width:
-                    dots = 1
-                    chars.reverse()
-            print ''  # finish progress indicator
-
         if args.platform == 'mac64':
-            sh('hdiutil mount %s' % filedest.name)
+            filename = os.path.basename(url)
+            print 'Saving %s' % filename
+            save_response(res, filename)
+            sh('hdiutil mount %s' % filename)
             sh('cp -r /Volumes/B2G/B2G.app ./')
             sh('hdiutil unmount /Volumes/B2G/')
-            os.unlink(filedest.name)
+            os.unlink(filename)
+            binary = 'B2G.app/Contents/MacOS/b2g-bin'
+        elif args.platform.startswith('linux'):
+            # Untar while downloading; nothing is written to disk twice.
+            print 'Extracting into %s' % dest
+            progress = Progress(int(res.headers['content-length']))
+            reader = ProgressReader(res.raw, progress)
+            with closing(tarfile.open(fileobj=reader, mode='r|bz2')) as tar:
+                tar.extractall()
+            progress.finish()
+            res.close()
+            binary = 'b2g/b2g'
+        else:
+            raise NotImplementedError(
+                'Not sure how to install for your platform %r'
+                % args.platform)
+
+        with open(version_file, 'w') as fp:
+            json.dump({'url': url, 'version': upstream_version(res)}, fp)
+
+        print 'NOTE: you still need to build a Gaia profile'
+        print 'Ready to run: '
+        print ('%s/%s -jsconsole -profile ...'
+               % (os.path.abspath(dest), binary))
+
+
+def get_flash_auth(args):
+    user = args.flash_user
+    password = args.flash_pass
+    if not user or not password:
+        done = False
+        while not done:
+            user = raw_input('LDAP username: ')
+            password = getpass('password: ')
+            if user_agrees():
+                done = True
+    return user, password
+
+
+def download_build(args, save_to=None, unzip=True):
+    print 'Downloading %s' % args.flash_url
+
+    auth = HTTPBasicAuth(*get_flash_auth(args))
+    zip_name = os.path.basename(args.flash_url)
+    previous = None
+    fetched = False
+
+    if save_to is None:
+        dest = os.path.join(args.work_dir, 'last-build')
+        staged = find_prefetched_build(args, args.flash_url, auth)
+        if staged:
+            print 'Using build prefetched to %s' % staged
+            if os.path.exists(dest):
+                shutil.rmtree(dest)
+            os.rename(staged, dest)
+            return os.path.join(dest, zip_name)
+        if os.path.exists(dest):
+            if getattr(args, 'delta', False):
+                previous = keep_previous_build(args, dest)
+            shutil.rmtree(dest)
+        os.mkdir(dest)
+    else:
+        dest = save_to
+    with pushd(dest):
+        print 'In %s' % dest
+        if previous:
+            try:
+                fetched = fetch_build_delta(args.flash_url, auth,
+                                            previous, zip_name)
+            except (DeltaError, requests.RequestException), exc:
+                print ' ** could not update incrementally: %s' % exc
+                fetched = False
+            os.unlink(previous)
+            if not fetched:
+                print 'Falling back to a full download'
+        if not fetched:
+            fetch_build(args, auth, zip_name)
+
+        if unzip:
+            sh('unzip %s' % zip_name)
+        return os.path.abspath(zip_name)
+
+
+def fetch_build(args, auth, zip_name):
+    res = requests.get(args.flash_url, auth=auth, stream=True)
+    if res.status_code != 200:
+        args.error('Got %s from %s (Is your password correct? '
+                   'Is the URL correct?)' % (res.status_code,
+                                             args.flash_url))
+    print 'Saving %s' % zip_name
+    save_response(res, zip_name, segments=getattr(args, 'segments', 1),
+                  auth=auth)
+
+
+class Progress(object):
+    """A terminal progress indicator that can be updated from threads."""
+
+    def __init__(self, total_bytes, width=TERM_WIDTH):
+        self.total_bytes = total_bytes
+        self.width = width
+        self.bytes_down = 0
+        self.dots = 1
+        self.chars = ['.', ' ']
+        self.lock = threading.Lock()
+
+    def update(self, num_bytes):
+        with self.lock:
+            self.bytes_down += num_bytes
+            sys.stdout.write("\r%s%s %2.2f%%"
+                             % (self.chars[0] * self.dots,
+                                self.chars[1] * (self.width - self.dots),
+                                100.0 * self.bytes_down / self.total_bytes))
+            sys.stdout.flush()
+            self.dots += 1
+            if self.dots >= self.width:
+                self.dots = 1
+                self.chars.reverse()
+
+    def finish(self):
+        print ''  # finish progress indicator
+
+
+def preallocate(fd, size):
+    """Reserves disk space for a file so it is written without growing."""
+    libc_name = ctypes.util.find_library('c')
+    libc = ctypes.CDLL(libc_name) if libc_name else None
+    # Not available on Mac.
+    fallocate = getattr(libc, 'posix_fallocate64', None) or \
+        getattr(libc, 'posix_fallocate', None)
+    if fallocate:
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        if fallocate(fd, 0, size) == 0:
+            return
+    os.ftruncate(fd, size)
+
+
+class Throttle(object):
+    """Limits the combined rate of downloads sharing it."""
+
+    def __init__(self, max_rate):
+        self.max_rate = float(max_rate)  # bytes per second
+        self.start = time.time()
+        self.bytes_down = 0
+        self.lock = threading.Lock()
+
+    def update(self, num_bytes):
+        with self.lock:
+            self.bytes_down += num_bytes
+            delay = (self.bytes_down / self.max_rate -
+                     (time.time() - self.start))
+        if delay > 0:
+            time.sleep(delay)
+
+
+def write_segment(res, path, offset, length, progress, throttle=None):
+    """Writes length bytes of a streaming response at offset in path.
+
+    Each segment has its own file descriptor so segments can be written
+    from several threads without locking.
+    """
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.lseek(fd, offset, os.SEEK_SET)
+        remaining = length
+        while remaining:
+            data = res.raw.read(min(remaining, DOWNLOAD_BUFFER_SIZE))
+            if not data:
+                raise IOError('Connection closed with %s bytes left'
+                              % remaining)
+            written = 0
+            while written < len(data):
+                written += os.write(fd, data[written:])
+            remaining -= len(data)
+            progress.update(len(data))
+            if throttle:
+                throttle.update(len(data))
+    finally:
+        os.close(fd)
+        res.close()
+
+
+def save_response(res, path, segments=1, auth=None, max_rate=None):
+    """Saves a streaming 200 response to path.
+
+    The file is preallocated from Content-Length. With segments > 1 and a
+    server that supports ranges, the rest of the file is downloaded over
+    parallel connections while res supplies the first segment. max_rate
+    limits the total download rate in bytes per second.
+    """
+    total = int(res.headers['content-length'])
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        preallocate(fd, total)
+    finally:
+        os.close(fd)
+
+    progress = Progress(total)
+    throttle = Throttle(max_rate) if max_rate else None
+    if (segments < 2 or res.headers.get('accept-ranges') != 'bytes' or
+            total < segments * DOWNLOAD_BUFFER_SIZE):
+        write_segment(res, path, 0, total, progress, throttle)
+        progress.finish()
+        return
+
+    size = total // segments
+    bounds = [(i * size, total - i * size if i == segments - 1 else size)
+              for i in range(segments)]
+    errors = []
+
+    def fetch(offset, length):
+        try:
+            seg = requests.get(res.url, auth=auth, stream=True, headers={
+                'Range': 'bytes=%s-%s' % (offset, offset + length - 1)})
+            if seg.status_code != 206:
+                seg.close()
+                raise IOError('Got %s for a range of %s'
+                              % (seg.status_code, res.url))
+            write_segment(seg, path, offset, length, progress, throttle)
+        except Exception, exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=fetch, args=b) for b in bounds[1:]]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        write_segment(res, path, 0, bounds[0][1], progress, throttle)
+    except Exception, exc:
+        errors.append(exc)
+    for thread in threads:
+        thread.join()
+    progress.finish()
+    if errors:
+        raise errors[0]
+
+
+# Reusable bytes shorter than this are downloaded again rather than copied
+# so that neighboring ranges can be fetched with a single request.
+DELTA_GAP = 1024 * 64
+ZIP_EOCD = struct.Struct('<4s4H2LH')
+ZIP_CENTRAL_ENTRY = struct.Struct('<4s6H3L5H2L')
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+class DeltaError(Exception):
+    pass
+
+
+def keep_previous_build(args, dest):
+    """Moves the last downloaded zip aside to update it incrementally."""
+    old_zip = os.path.join(dest, os.path.basename(args.flash_url))
+    if not os.path.exists(old_zip):
+        return None
+    previous = os.path.join(args.work_dir, 'previous-build.zip')
+    os.rename(old_zip, previous)
+    return previous
+
+
+def fetch_range(session, url, start, end):
+    res = session.get(url, headers={'Range': 'bytes=%s-%s' % (start, end)},
+                      stream=True)
+    if res.status_code != 206:
+        res.close()
+        raise DeltaError('Got %s for a range request to %s; the server '
+                         'might not support ranges' % (res.status_code, url))
+    if not res.headers.get('content-range', '').startswith(
+            'bytes %s-' % start):
+        res.close()
+        raise DeltaError('Unexpected Content-Range: %s'
+                         % res.headers.get('content-range'))
+    return res
+
+
+def read_remote_zip_directory(session, url):
+    """Reads the central directory of a remote zip.
+
+    Returns (size, directory offset, tail offset, tail bytes, entries)
+    where each entry is a tuple of (name, flags, method, crc,
+    compressed size, local header offset). Only the end of the file is
+    downloaded.
+    """
+    res = session.head(url, allow_redirects=True)
+    if res.status_code != 200:
+        raise DeltaError('Got %s from %s' % (res.status_code, url))
+    size = int(res.headers['content-length'])
+
+    # The end of central directory record is at most 64K from the end.
+    tail_start = max(0, size - (ZIP_EOCD.size + 0xFFFF))
+    tail = fetch_range(session, url, tail_start, size - 1).content
+    pos = tail.rfind('PK\x05\x06')
+    if pos < 0:
+        raise DeltaError('No zip directory found in %s' % url)
+    (sig, disk, cd_disk, count, total, cd_size, cd_offset,
+     comment_len) = ZIP_EOCD.unpack(tail[pos:pos + ZIP_EOCD.size])
+    if cd_offset == 0xFFFFFFFF or total == 0xFFFF:
+        raise DeltaError('Zip64 archives are not supported')
+
+    if cd_offset >= tail_start:
+        directory = tail[cd_offset - tail_start:
+                         cd_offset - tail_start + cd_size]
+    else:
+        directory = fetch_range(session, url, cd_offset,
+                                cd_offset + cd_size - 1).content
+
+    entries = []
+    pos = 0
+    for i in range(total):
+        fields = ZIP_CENTRAL_ENTRY.unpack(
+            directory[pos:pos + ZIP_CENTRAL_ENTRY.size])
+        if fields[0] != 'PK\x01\x02':
+            raise DeltaError('Corrupt zip directory in %s' % url)
+        flags, method, crc, csize = (fields[3], fields[4], fields[7],
+                                     fields[8])
+        name_len, extra_len, comment_len = fields[10:13]
+        offset = fields[16]
+        name_start = pos + ZIP_CENTRAL_ENTRY.size
+        name = directory[name_start:name_start + name_len]
+        entries.append((name, flags, method, crc, csize, offset))
+        pos = name_start + name_len + extra_len + comment_len
+    return size, cd_offset, tail_start, tail, entries
+
+
+def plan_zip_delta(old_zip, cd_offset, entries):
+    """Works out which parts of the new zip can be copied from old_zip.
+
+    Returns a list of ('copy', start, length, old_offset) and
+    ('fetch', start, length) segments covering the new file up to its
+    central directory.
+    """
+    old_data = {}
+    with open(old_zip, 'rb') as fp:
+        for info in zipfile.ZipFile(fp).infolist():
+            fp.seek(info.header_offset)
+            header = fp.read(ZIP_LOCAL_HEADER_SIZE)
+            name_len, extra_len = struct.unpack('<2H', header[26:30])
+            old_data[info.filename] = (
+                info.compress_type, info.CRC, info.compress_size,
+                info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_len
+                + extra_len)
+
+    entries = sorted(entries, key=lambda e: e[5])
+    segments = []
+    if entries and entries[0][5] > 0:
+        segments.append(('fetch', 0, entries[0][5]))
+    for i, (name, flags, method, crc, csize, offset) in enumerate(entries):
+        end = entries[i + 1][5] if i + 1 < len(entries) else cd_offset
+        old = old_data.get(name)
+        header_len = end - offset - csize
+        # Entries with a trailing data descriptor (flag bit 3) have no fixed
+        # header length so they are always fetched.
+        if (old and old[:3] == (method, crc, csize) and not flags & 0x8
+                and header_len >= ZIP_LOCAL_HEADER_SIZE):
+            segments.append(('fetch', offset, header_len))
+            segments.append(('copy', offset + header_len, csize, old[3]))
+        else:
+            segments.append(('fetch', offset, end - offset))
+
+    merged = []
+    for seg in segments:
+        if seg[0] == 'copy' and seg[2] < DELTA_GAP:
+            seg = ('fetch', seg[1], seg[2])
+        if (seg[0] == 'fetch' and merged and merged[-1][0] == 'fetch'
+                and merged[-1][1] + merged[-1][2] == seg[1]):
+            merged[-1] = ('fetch', merged[-1][1], merged[-1][2] + seg[2])
+        elif seg[2]:
+            merged.append(seg)
+    return merged
+
+
+def fetch_build_delta(url, auth, old_zip, zip_name):
+    """Rebuilds the zip at url using unchanged entries from old_zip.
+
+    Zip entries are compressed individually so any entry with the same
+    name, CRC and compressed size as in the old build is copied locally and
+    everything else is downloaded with HTTP range requests.
+    Returns True if the rebuilt zip verified correctly.
+    """
+    session = requests.Session()
+    session.auth = auth
+    size, cd_offset, tail_start, tail, entries = read_remote_zip_directory(
+        session, url)
+    segments = plan_zip_delta(old_zip, cd_offset, entries)
+    to_fetch = sum(seg[2] for seg in segments if seg[0] == 'fetch')
+    print 'Updating %s incrementally: downloading %s of %s bytes' % (
+        zip_name, to_fetch + (size - cd_offset), size)
+
+    with open(old_zip, 'rb') as old, open(zip_name, 'wb') as new:
+        preallocate(new.fileno(), size)
+        for seg in segments:
+            new.seek(seg[1])
+            if seg[0] == 'copy':
+                old.seek(seg[3])
+                remaining = seg[2]
+                while remaining:
+                    chunk = old.read(min(remaining, CHUNK_SIZE * 10))
+                    if not chunk:
+                        raise DeltaError('%s is truncated' % old_zip)
+                    new.write(chunk)
+                    remaining -= len(chunk)
+            else:
+                res = fetch_range(session, url, seg[1], seg[1] + seg[2] - 1)
+                for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                    new.write(chunk)
+                if new.tell() != seg[1] + seg[2]:
+                    raise DeltaError('Short read from %s' % url)
+        # The central directory and everything after it came with the tail
+        # unless the directory was too big to fit.
+        if cd_offset < tail_start:
+            new.seek(cd_offset)
+            res = fetch_range(session, url, cd_offset, tail_start - 1)
+            for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                new.write(chunk)
+            new.seek(tail_start)
+            new.write(tail)
+        else:
+            new.seek(cd_offset)
+            new.write(tail[cd_offset - tail_start:])
+
+    try:
+        bad = zipfile.ZipFile(zip_name).testzip()
+    except (zipfile.BadZipfile, IOError, struct.error), exc:
+        bad = exc
+    if bad is not None or os.path.getsize(zip_name) != size:
+        print ' ** rebuilt zip failed verification: %s' % bad
+        os.unlink(zip_name)
+        return False
+    print 'Verified %s' % zip_name
+    return True
+
+
+def prefetch_dir(args, url):
+    return os.path.join(args.work_dir, 'prefetch',
+                        hashlib.sha1(url).hexdigest())
+
+
+def find_prefetched_build(args, url, auth):
+    """Returns the staged directory for the current build at url, if any."""
+    url_dir = prefetch_dir(args, url)
+    if not os.path.isdir(url_dir):
+        return None
+    res = requests.head(url, auth=auth, allow_redirects=True)
+    if res.status_code != 200:
+        return None
+    staged = os.path.join(url_dir,
+                          hashlib.md5(upstream_version(res)).hexdigest())
+    if os.path.exists(os.path.join(staged, '.ezboot-prefetch.json')):
+        return staged
+
+
+def prefetch_build(args, url, auth):
+    """Downloads and unzips the build at url unless it is already staged."""
+    if find_prefetched_build(args, url, auth):
+        print 'Already prefetched the latest %s' % url
+        return
+
+    res = requests.get(url, auth=auth, stream=True)
+    if res.status_code != 200:
+        res.close()
+        print ' ** got %s from %s' % (res.status_code, url)
+        return
+    version = upstream_version(res)
+    url_dir = prefetch_dir(args, url)
+    staged = os.path.join(url_dir, hashlib.md5(version).hexdigest())
+    tmp = staged + '.part'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    print 'Prefetching %s' % url
+    zip_name = os.path.basename(url)
+    with pushd(tmp):
+        max_rate = args.max_rate * 1024 if args.max_rate else None
+        save_response(res, zip_name, max_rate=max_rate)
+        sh('unzip -q %s' % zip_name)
+        with open('.ezboot-prefetch.json', 'w') as fp:
+            json.dump({'url': url, 'version': version,
+                       'fetched': time.time()}, fp)
+    os.rename(tmp, staged)
+    print 'Staged %s in %s' % (url, staged)
+
+    # Keep only the newest builds.
+    builds = []
+    for name in os.listdir(url_dir):
+        meta = os.path.join(url_dir, name, '.ezboot-prefetch.json')
+        if os.path.exists(meta):
+            with open(meta) as fp:
+                builds.append((json.load(fp)['fetched'], name))
+    for fetched, name in sorted(builds, reverse=True)[args.keep:]:
+        print 'Removing old prefetched build %s' % name
+        shutil.rmtree(os.path.join(url_dir, name))
+
+
+def seconds_until(at):
+    """Returns the seconds until the next time it is HH:MM locally."""
+    hour, minute = [int(n) for n in at.split(':')]
+    now = time.localtime()
+    target = time.mktime(now[:3] + (hour, minute, 0) + now[6:])
+    if target <= time.time():
+        target += 24 * 3600
+    return target - time.time()
+
+
+@adb_not_required
+def do_prefetch(args):
+    urls = as_list(args.prefetch_urls)
+    if args.flash_url:
+        urls.append(args.flash_url)
+    elif args.flash_device and args.flash_device.lower() in DEFAULT_BUILD_URLS:
+        urls.append(DEFAULT_BUILD_URLS[args.flash_device.lower()])
+    if not urls:
+        urls = DEFAULT_BUILD_URLS.values()
+    if args.at and args.interval:
+        args.error('Use either --at or --interval, not both')
+    if args.at:
+        try:
+            seconds_until(args.at)
+        except ValueError:
+            args.error('--at should look like HH:MM')
+
+    auth = HTTPBasicAuth(*get_flash_auth(args))
+    while True:
+        if args.at:
+            wait = seconds_until(args.at)
+            print 'Next prefetch at %s (in %.1f hours)' % (args.at,
+                                                           wait / 3600)
+            time.sleep(wait)
+        for url in urls:
+            try:
+                prefetch_build(args, url, auth)
+            except Exception, exc:
+                print ' ** could not prefetch %s: %s: %s' % (
+                    url, exc.__class__.__name__, exc)
+        if args.interval:
+            time.sleep(args.interval * 60)
+        elif not args.at:
+            break
+
+
+class MirrorFile(object):
+    """A build on disk that may still be downloading from upstream.
+
+    Readers wait on cond until the bytes they want have been received.
+    """
+
+    def __init__(self, path, etag, size):
+        self.path = path
+        self.etag = etag
+        self.size = size
+        self.received = 0
+        self.done = False
+        self.failed = False
+        self.cond = threading.Condition()
+
+    def wait_for(self, offset):
+        """Blocks until offset has been received; returns bytes available."""
+        with self.cond:
+            while self.received <= offset and not self.done:
+                self.cond.wait(1)
+            if self.failed:
+                raise IOError('Upstream download of %s failed' % self.path)
+            return self.received
+
+
+class UpstreamError(Exception):
+
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+
+class BuildMirror(object):
+    """Fetches each upstream build once and shares it with all clients."""
+
+    def __init__(self, upstream, auth, cache_dir, max_age):
+        self.upstream = upstream.rstrip('/')
+        self.auth = auth
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.files = {}
+        self.checked = {}
+        # Paths someone is checking upstream right now.
+        self.checking = {}
+        self.lock = threading.Lock()
+
+    def key(self, path):
+        return os.path.join(self.cache_dir, hashlib.sha1(path).hexdigest())
+
+    def upstream_url(self, path):
+        """Returns the upstream URL for a request path.
+
+        Raises UpstreamError(400) for anything that could send our
+        credentials to another host, such as //host/ or @host paths.
+        """
+        if (not path.startswith('/') or path.startswith('//') or
+                '..' in path.split('?')[0].split('/')):
+            raise UpstreamError(400)
+        url = urlparse.urljoin(self.upstream + '/', path.lstrip('/'))
+        want = urlparse.urlsplit(self.upstream)
+        got = urlparse.urlsplit(url)
+        if (got.scheme, got.netloc) != (want.scheme, want.netloc):
+            raise UpstreamError(400)
+        return url
+
+    def load(self, path):
+        """Returns a completed download from a previous run, if any."""
+        meta = self.key(path) + '.json'
+        if not os.path.exists(meta):
+            return None
+        with open(meta) as fp:
+            data = json.load(fp)
+        if not os.path.exists(data['path']):
+            return None
+        entry = MirrorFile(data['path'], data['etag'], data['size'])
+        entry.received = entry.size
+        entry.done = True
+        return entry
+
+    def get(self, path):
+        while True:
+            with self.lock:
+                entry = self.files.get(path) or self.load(path)
+                if entry and not entry.failed and (not entry.done or
+                              time.time() - self.checked.get(path, 0)
+                              < self.max_age):
+                    return entry
+                waiting = self.checking.get(path)
+                if waiting is None:
+                    self.checking[path] = threading.Event()
+                    break
+            # Another client is asking upstream about this path; see what
+            # it found instead of asking again.
+            waiting.wait()
+
+        # Talk to upstream without the lock so that clients of other
+        # builds aren't held up.
+        try:
+            return self.refresh(path, entry)
+        finally:
+            with self.lock:
+                self.checking.pop(path).set()
+
+    def refresh(self, path, entry):
+        """Checks upstream for a newer build than entry and starts
+        fetching it if there is one."""
+        url = self.upstream_url(path)
+        res = requests.head(url, auth=self.auth, allow_redirects=True)
+        if res.status_code != 200:
+            raise UpstreamError(res.status_code)
+        etag = upstream_version(res)
+        if entry and not entry.failed and entry.etag == etag:
+            with self.lock:
+                self.checked[path] = time.time()
+                self.files[path] = entry
+            return entry
+
+        print 'Fetching %s' % url
+        res = requests.get(url, auth=self.auth, stream=True)
+        if res.status_code != 200:
+            raise UpstreamError(res.status_code)
+        etag = upstream_version(res)
+        data_path = '%s-%s' % (self.key(path), hashlib.md5(etag).hexdigest())
+        new_entry = MirrorFile(data_path, etag,
+                               int(res.headers['content-length']))
+        # Create the file before any reader can see the entry.
+        fd = os.open(data_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+        with self.lock:
+            self.checked[path] = time.time()
+            self.files[path] = new_entry
+        thread = threading.Thread(target=self.fetch,
+                                  args=(path, res, fd, new_entry, entry))
+        thread.daemon = True
+        thread.start()
+        return new_entry
+
+    def fetch(self, path, res, fd, entry, old_entry):
+        try:
+            for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                os.write(fd, chunk)
+                with entry.cond:
+                    entry.received += len(chunk)
+                    entry.cond.notify_all()
+            if entry.received != entry.size:
+                raise IOError('Got %s of %s bytes'
+                              % (entry.received, entry.size))
+        except Exception, exc:
+            print ' ** failed to fetch %s: %s' % (path, exc)
+            entry.failed = True
+        finally:
+            os.close(fd)
+            res.close()
+            with entry.cond:
+                entry.done = True
+                entry.cond.notify_all()
+
+        if entry.failed:
+            os.unlink(entry.path)
+            return
+        with open(self.key(path) + '.json', 'w') as fp:
+            json.dump({'path': entry.path, 'etag': entry.etag,
+                       'size': entry.size}, fp)
+        if old_entry and old_entry.path != entry.path:
+            # Clients still reading the old build keep their open file.
+            try:
+                os.unlink(old_entry.path)
+            except OSError:
+                pass
+        print 'Mirrored %s (%s bytes)' % (path, entry.size)
+
+
+def upstream_version(res):
+    """Returns a token that changes whenever the upstream file changes."""
+    etag = res.headers.get('etag')
+    if etag:
+        return etag.strip('"')
+    return hashlib.md5('%s:%s' % (res.headers.get('last-modified'),
+                                  res.headers.get('content-length'))
+                       ).hexdigest()
+
+
+def parse_range(header, size):
+    """Returns (start, end) for a single byte range header, inclusive.
+
+    Returns None if the header is not a range we support and raises
+    ValueError if the range cannot be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, _, end = header[len('bytes='):].strip().partition('-')
+    try:
+        if not start:
+            # A suffix range like bytes=-500
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise ValueError('Unsatisfiable range %s' % header)
+    return start, end
+
+
+class MirrorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_HEAD(self):
+        self.serve(send_body=False)
+
+    def do_GET(self):
+        self.serve(send_body=True)
+
+    def serve(self, send_body):
+        try:
+            entry = self.server.mirror.get(self.path)
+        except UpstreamError, exc:
+            self.send_error(exc.status)
+            return
+        except requests.RequestException, exc:
+            print ' ** %s: %s' % (exc.__class__.__name__, exc)
+            self.send_error(502)
+            return
+
+        etag = '"%s"' % entry.etag
+        if self.headers.get('if-none-match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        try:
+            byte_range = parse_range(self.headers.get('range'), entry.size)
+        except ValueError:
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */%s' % entry.size)
+            self.end_headers()
+            return
+
+        if byte_range and self.headers.get('if-range', etag) == etag:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %s-%s/%s' % (start, end, entry.size))
+        else:
+            start, end = 0, entry.size - 1
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.end_headers()
+        if not send_body:
+            return
+
+        with open(entry.path, 'rb') as fp:
+            fp.seek(start)
+            offset = start
+            while offset <= end:
+                available = entry.wait_for(offset)
+                chunk = fp.read(min(available, end + 1) - offset)
+                if not chunk:
+                    raise IOError('Unexpected end of %s' % entry.path)
+                self.wfile.write(chunk)
+                offset += len(chunk)
+
+
+class MirrorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+@adb_not_required
+def serve_mirror(args):
+    cache_dir = os.path.join(args.work_dir, 'mirror')
+    if not os.path.exists(cache_dir):
+        os.mkdir(cache_dir)
+    mirror = BuildMirror(args.mirror_upstream,
+                         HTTPBasicAuth(*get_flash_auth(args)),
+                         cache_dir, args.mirror_max_age)
+    server = MirrorServer((args.mirror_bind, args.mirror_port),
+                          MirrorHandler)
+    server.mirror = mirror
+    print 'Mirroring %s on %s:%s (^C to quit)' % (
+        mirror.upstream, args.mirror_bind, args.mirror_port)
+    host = args.mirror_bind
+    if host in ('', '0.0.0.0'):
+        host = socket.gethostname()
+    if not host.startswith('127.'):
+        print (' ** anyone who can reach this address can download builds '
+               'with your credentials')
+    print 'Point ezboot at it with, e.g.:'
+    print '  --flash_url http://%s:%s/<path on %s>' % (
+        host, args.mirror_port, mirror.upstream)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print
+    finally:
+        server.server_close()
+
+
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'proxy-authenticate',
+                      'proxy-authorization', 'proxy-connection', 'te',
+                      'trailer', 'transfer-encoding', 'upgrade')
+
+
+def http_date(value):
+    parsed = parsedate(value) if value else None
+    return calendar.timegm(parsed) if parsed else None
+
+
+def freshness_lifetime(headers):
+    """Returns how many seconds a response may be served from cache."""
+    cache_control = headers.get('cache-control', '').lower()
+    for directive in cache_control.split(','):
+        name, _, value = directive.strip().partition('=')
+        if name in ('s-maxage', 'max-age'):
+            try:
+                return int(value.strip('"'))
+            except ValueError:
+                return 0
+    if 'no-cache' in cache_control:
+        return 0
+    date = http_date(headers.get('date')) or time.time()
+    expires = http_date(headers.get('expires'))
+    if expires is not None:
+        return max(expires - date, 0)
+    last_modified = http_date(headers.get('last-modified'))
+    if last_modified is not None:
+        # The usual heuristic: 10% of the time since it last changed.
+        return max((date - last_modified) / 10, 0)
+    return 0
+
+
+def is_cacheable(req_headers, status, headers):
+    if (status != 200 or 'authorization' in req_headers or
+            'cookie' in req_headers or 'set-cookie' in headers):
+        return False
+    cache_control = headers.get('cache-control', '').lower()
+    if 'no-store' in cache_control or 'private' in cache_control:
+        return False
+    return headers.get('vary', '').strip() != '*'
+
+
+def vary_values(names, req_headers):
+    """Returns {header: value} of the request headers a response varies on.
+
+    A cached response is only served to requests with the same values.
+    """
+    return dict((name, req_headers.get(name)) for name in names)
+
+
+class ProxyCache(object):
+    """Responses on disk, keyed by URL and evicted least recently used."""
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.fetching = {}
+
+    def begin_fetch(self, url):
+        """Returns None if the caller should fetch url itself.
+
+        Otherwise another request is already fetching it and this returns
+        an Event that is set when that fetch is over.
+        """
+        with self.lock:
+            if url in self.fetching:
+                return self.fetching[url]
+            self.fetching[url] = threading.Event()
+            return None
+
+    def end_fetch(self, url):
+        with self.lock:
+            self.fetching.pop(url).set()
+
+    def key(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest())
+
+    def lookup(self, url):
+        key = self.key(url)
+        try:
+            with open(key + '.json') as fp:
+                meta = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if not os.path.exists(key + '.body'):
+            return None
+        # Mark it as recently used for eviction.
+        os.utime(key + '.json', None)
+        return meta
+
+    def body_path(self, url):
+        return self.key(url) + '.body'
+
+    def save_meta(self, url, meta):
+        tmp = self.key(url) + '.json.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(meta, fp)
+        os.rename(tmp, self.key(url) + '.json')
+
+    def store(self, url, meta, tmp_body):
+        os.rename(tmp_body, self.body_path(url))
+        self.save_meta(url, meta)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            total = 0
+            for fn in os.listdir(self.cache_dir):
+                if not fn.endswith('.json'):
+                    continue
+                key = os.path.join(self.cache_dir, fn[:-len('.json')])
+                try:
+                    size = os.path.getsize(key + '.body')
+                    used = os.path.getmtime(key + '.json')
+                except OSError:
+                    continue
+                entries.append((used, size, key))
+                total += size
+            for used, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for ext in ('.json', '.body'):
+                    try:
+                        os.unlink(key + ext)
+                    except OSError:
+                        pass
+                total -= size
+
+
+PROXY_CA_NAME = 'ezboot proxy CA'
+PROXY_CA_CONFIG = """
+[req]
+distinguished_name = dn
+prompt = no
+
+[dn]
+CN = %(cn)s
+
+[ca]
+basicConstraints = critical,CA:TRUE
+keyUsage = critical,keyCertSign,cRLSign
+subjectKeyIdentifier = hash
+
+[leaf]
+basicConstraints = CA:FALSE
+keyUsage = digitalSignature,keyEncipherment
+extendedKeyUsage = serverAuth
+subjectAltName = %(alt_name)s
+"""
+
+
+class ProxyCA(object):
+    """A certificate authority for intercepting HTTPS, made with openssl.
+
+    Devices trust it once it is installed with setup --proxy. Each host
+    gets a certificate signed by it, all sharing one key.
+    """
+
+    def __init__(self, ca_dir):
+        self.ca_dir = ca_dir
+        self.ca_cert = os.path.join(ca_dir, 'ca.pem')
+        self.ca_key = os.path.join(ca_dir, 'ca.key')
+        self.host_key = os.path.join(ca_dir, 'host.key')
+        self.lock = threading.Lock()
+        if not os.path.exists(os.path.join(ca_dir, 'hosts')):
+            os.makedirs(os.path.join(ca_dir, 'hosts'))
+        if not os.path.exists(self.ca_cert):
+            print 'Creating proxy CA %s' % self.ca_cert
+            self.openssl(PROXY_CA_NAME, 'DNS:ezboot',
+                         'req -x509 -new -nodes -newkey rsa:2048 -sha256 '
+                         '-days 3650 -extensions ca -keyout {ca_key} '
+                         '-out {ca_cert}')
+        if not os.path.exists(self.host_key):
+            self.openssl(PROXY_CA_NAME, 'DNS:ezboot',
+                         'genrsa -out {host_key} 2048')
+
+    def openssl(self, cn, alt_name, command):
+        fd, config = tempfile.mkstemp(suffix='.cnf')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(PROXY_CA_CONFIG % {'cn': cn, 'alt_name': alt_name})
+            args = command.format(ca_key=self.ca_key, ca_cert=self.ca_cert,
+                                  host_key=self.host_key, config=config)
+            if args.startswith('req'):
+                args += ' -config %s' % config
+            with open(os.devnull, 'w') as devnull:
+                check_call('openssl %s' % args, shell=True, stdout=devnull,
+                           stderr=devnull)
+        finally:
+            os.unlink(config)
+
+    def cert_for(self, host):
+        """Returns a PEM file with a certificate for host and its key."""
+        if not re.match(r'^[\w.-]+$', host):
+            raise ValueError('Bad host name: %r' % host)
+        pem = os.path.join(self.ca_dir, 'hosts', '%s.pem' % host)
+        with self.lock:
+            if os.path.exists(pem):
+                return pem
+            alt_name = ('IP:%s' % host if re.match(r'^[\d.]+$', host)
+                        else 'DNS:%s' % host)
+            csr = pem + '.csr'
+            crt = pem + '.crt'
+            self.openssl(host, alt_name,
+                         'req -new -key {host_key} -out %s' % csr)
+            self.openssl(host, alt_name,
+                         'x509 -req -in %s -CA {ca_cert} -CAkey {ca_key} '
+                         '-set_serial %d -days 825 -sha256 -extfile {config} '
+                         '-extensions leaf -out %s'
+                         % (csr, int(time.time() * 1000), crt))
+            with open(pem + '.tmp', 'w') as out:
+                for path in (crt, self.host_key):
+                    with open(path) as fp:
+                        out.write(fp.read())
+            os.rename(pem + '.tmp', pem)
+            os.unlink(csr)
+            os.unlink(crt)
+            return pem
+
+
+class ProxyHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # host:port of the CONNECT tunnel when intercepting HTTPS.
+    tunnel_host = None
+
+    def do_CONNECT(self):
+        if self.server.ca:
+            self.intercept()
+            return
+        # HTTPS can't be cached without intercepting it so just tunnel.
+        host, _, port = self.path.partition(':')
+        try:
+            upstream = socket.create_connection((host, int(port or 443)))
+        except (socket.error, ValueError), exc:
+            self.send_error(502, str(exc))
+            return
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        conns = [self.connection, upstream]
+        try:
+            while True:
+                readable, _, errored = select_module.select(conns, [], conns,
+                                                            60)
+                if errored or not readable:
+                    break
+                for conn in readable:
+                    data = conn.recv(CHUNK_SIZE)
+                    if not data:
+                        return
+                    other = upstream if conn is self.connection else \
+                        self.connection
+                    other.sendall(data)
+        finally:
+            upstream.close()
 
-            print 'NOTE: you still need to build a Gaia profile'
-            print 'Ready to run: '
-            print ('%s/B2G.app/Contents/MacOS/b2g-bin -jsconsole -profile ...'
-                   % os.path.abspath(dest))
+    def intercept(self):
+        """Answers the CONNECT itself and serves the requests inside the
+        TLS connection like plain proxy requests."""
+        host = self.path.partition(':')[0]
+        try:
+            pem = self.server.ca.cert_for(host)
+        except (ValueError, subprocess.CalledProcessError), exc:
+            self.send_error(502, str(exc))
+            return
+        self.send_response(200, 'Connection established')
+        self.end_headers()
+        self.wfile.flush()
+        try:
+            tls = ssl.wrap_socket(self.connection, server_side=True,
+                                  certfile=pem)
+        except (ssl.SSLError, socket.error), exc:
+            print (' ** TLS with %s failed for %s (%s). Did you run setup '
+                   '--proxy to install the proxy CA on the device?'
+                   % (self.client_address[0], host, exc))
+            self.close_connection = 1
+            return
+        self.tunnel_host = self.path
+        self.connection = tls
+        self.rfile = tls.makefile('rb', self.rbufsize)
+        self.wfile = tls.makefile('wb', self.wbufsize)
+        self.close_connection = 0
+        while not self.close_connection:
+            self.handle_one_request()
+        self.close_connection = 1
+
+    def absolute_url(self):
+        if self.tunnel_host and self.path.startswith('/'):
+            host = self.tunnel_host
+            if host.endswith(':443'):
+                host = host[:-len(':443')]
+            return 'https://%s%s' % (host, self.path)
+        return self.path
+
+    def do_GET(self):
+        url = self.absolute_url()
+        cache = self.server.cache
+        req_headers = self.request_headers()
+        if 'authorization' in req_headers or 'cookie' in req_headers:
+            # Someone's own responses never go through the cache.
+            self.fetch(url, req_headers, None)
+            return
+
+        meta = self.lookup(url, req_headers)
+        if meta and time.time() - meta['stored'] < meta['lifetime']:
+            self.send_cached(meta, cache.body_path(url), 'HIT')
+            return
+
+        waiting = cache.begin_fetch(url)
+        if waiting is None:
+            try:
+                self.fetch(url, req_headers, meta)
+            finally:
+                cache.end_fetch(url)
+            return
+
+        # Another device is downloading this right now; use its copy.
+        waiting.wait()
+        meta = self.lookup(url, req_headers)
+        if meta and time.time() - meta['stored'] < meta['lifetime']:
+            self.send_cached(meta, cache.body_path(url), 'HIT')
         else:
-            raise NotImplementedError(
-                'Not sure how to install for your platform %r'
-                % args.platform)
+            self.fetch(url, req_headers, meta)
+
+    def lookup(self, url, req_headers):
+        """Returns the cached meta for url if it was stored for a request
+        with the same values of the headers the response varies on."""
+        meta = self.server.cache.lookup(url)
+        if meta and meta['vary'] == vary_values(meta['vary'], req_headers):
+            return meta
+        return None
+
+    def fetch(self, url, req_headers, meta):
+        """Gets url from upstream, revalidating the cached meta if any."""
+        cache = self.server.cache
+        if meta:
+            # Stale: ask upstream whether our copy is still good.
+            conditional = dict(req_headers)
+            if meta['headers'].get('etag'):
+                conditional['If-None-Match'] = meta['headers']['etag']
+            if meta['headers'].get('last-modified'):
+                conditional['If-Modified-Since'] = \
+                    meta['headers']['last-modified']
+            res = self.upstream('GET', url, conditional)
+            if res is None:
+                return
+            if res.status_code == 304:
+                res.close()
+                meta['headers'].update(self.response_headers(res))
+                meta['stored'] = time.time()
+                meta['lifetime'] = freshness_lifetime(meta['headers'])
+                cache.save_meta(url, meta)
+                self.send_cached(meta, cache.body_path(url), 'REVALIDATED')
+                return
+        else:
+            res = self.upstream('GET', url, req_headers)
+            if res is None:
+                return
+
+        headers = self.response_headers(res)
+        if not is_cacheable(req_headers, res.status_code, headers):
+            self.relay(res, headers, None)
+            return
+
+        vary = [name.strip().lower()
+                for name in headers.get('vary', '').split(',')
+                if name.strip()]
+        fd, tmp = tempfile.mkstemp(dir=cache.cache_dir, suffix='.part')
+        with os.fdopen(fd, 'wb') as fp:
+            complete = self.relay(res, headers, fp)
+        if complete:
+            cache.store(url, {'status': res.status_code,
+                              'reason': res.reason,
+                              'headers': headers,
+                              'vary': vary_values(vary, req_headers),
+                              'stored': time.time(),
+                              'lifetime': freshness_lifetime(headers)}, tmp)
+        else:
+            os.unlink(tmp)
+
+    def do_OTHER(self):
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else None
+        res = self.upstream(self.command, self.absolute_url(),
+                            self.request_headers(), body)
+        if res is not None:
+            self.relay(res, self.response_headers(res), None)
+
+    do_HEAD = do_POST = do_PUT = do_DELETE = do_OPTIONS = do_OTHER
+
+    def request_headers(self):
+        return dict((k, v) for k, v in self.headers.items()
+                    if k.lower() not in HOP_BY_HOP_HEADERS)
+
+    def response_headers(self, res):
+        return dict((k.lower(), v) for k, v in res.headers.items()
+                    if k.lower() not in HOP_BY_HOP_HEADERS)
+
+    def upstream(self, method, url, headers, body=None):
+        if not url.startswith('http://') and not url.startswith('https://'):
+            self.send_error(400, 'Only absolute http(s):// URLs are '
+                                 'proxied')
+            return None
+        try:
+            return requests.request(method, url, headers=headers, data=body,
+                                    stream=True, allow_redirects=False)
+        except requests.RequestException, exc:
+            self.send_error(502, str(exc))
+            return None
+
+    def send_cached(self, meta, body_path, status):
+        self.send_response(meta['status'], meta['reason'])
+        for key, value in meta['headers'].items():
+            if key != 'content-length':
+                self.send_header(key, value)
+        self.send_header('Content-Length', str(os.path.getsize(body_path)))
+        self.send_header('X-Cache', status)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        with open(body_path, 'rb') as fp:
+            shutil.copyfileobj(fp, self.wfile, CHUNK_SIZE * 10)
+
+    def relay(self, res, headers, cache_fp):
+        """Streams an upstream response to the client and cache_fp.
+
+        Returns True if the whole body was received.
+        """
+        self.send_response(res.status_code, res.reason)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('X-Cache', 'MISS')
+        self.end_headers()
+        if self.command == 'HEAD':
+            res.close()
+            return False
+        received = 0
+        client_gone = False
+        try:
+            while True:
+                # Pass the body through exactly as it was encoded.
+                chunk = res.raw.read(CHUNK_SIZE, decode_content=False)
+                if not chunk:
+                    break
+                received += len(chunk)
+                if cache_fp:
+                    cache_fp.write(chunk)
+                if not client_gone:
+                    try:
+                        self.wfile.write(chunk)
+                    except socket.error:
+                        # Finish filling the cache anyway.
+                        client_gone = True
+                        if not cache_fp:
+                            break
+        finally:
+            res.close()
+        expected = headers.get('content-length')
+        return expected is None or int(expected) == received
 
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt,
+                                                              *args)
 
-def download_build(args, save_to=None, unzip=True):
-    print 'Downloading %s' % args.flash_url
 
-    user = args.flash_user
-    password = args.flash_pass
-    if not user or not password:
-        done = False
-        while not done:
-            user = raw_input('LDAP username: ')
-            password = getpass('password: ')
-            if user_agrees():
-                done = True
+class ProxyServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
 
-    if save_to is None:
-        dest = os.path.join(args.work_dir, 'last-build')
-        if os.path.exists(dest):
-            shutil.rmtree(dest)
-        os.mkdir(dest)
-    else:
-        dest = save_to
-    with pushd(dest):
-        print 'In %s' % dest
-        res = requests.get(args.flash_url,
-                           auth=HTTPBasicAuth(user, password), stream=True)
-        if res.status_code != 200:
-            args.error('Got %s from %s (Is your password correct? '
-                       'Is the URL correct?)' % (res.status_code,
-                                                 args.flash_url))
-        total_bytes = int(res.headers['content-length'])
-        zipdest = open(os.path.basename(args.flash_url), 'wb')
-        print 'Saving %s' % zipdest.name
-        dots = 1
-        chars = ['.', ' ']
-        bytes_down = 0
-        width = TERM_WIDTH
-        for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
-            bytes_down += CHUNK_SIZE
-            zipdest.write(chunk)
-            sys.stdout.write("\r%s%s %2.2f%%" % (chars[0] * dots,
-                                         chars[1] * (width - dots),
-                                         100.0 * bytes_down / total_bytes))
-            sys.stdout.flush()
-            dots += 1
-            if dots >= width:
-                dots = 1
-                chars.reverse()
-        print ''  # finish progress indicator
-        res.close()
-        zipdest.close()
 
-        if unzip:
-            sh('unzip %s' % zipdest.name)
-        return os.path.abspath(zipdest.name)
+@adb_not_required
+def run_proxy(args):
+    cache_dir = os.path.join(args.work_dir, 'proxy-cache')
+    if not os.path.exists(cache_dir):
+        os.mkdir(cache_dir)
+    server = ProxyServer((args.proxy_bind, args.proxy_port), ProxyHandler)
+    server.cache = ProxyCache(cache_dir, args.proxy_cache_size * 1024 * 1024)
+    server.ca = None
+    if args.intercept_https:
+        server.ca = ProxyCA(os.path.join(args.work_dir, 'proxy-ca'))
+    server.verbose = args.verbose
+    print 'Caching proxy listening on %s:%s (^C to quit)' % (
+        args.proxy_bind, args.proxy_port)
+    host = args.proxy_bind
+    if host in ('', '0.0.0.0'):
+        host = socket.gethostname()
+    if not host.startswith('127.'):
+        print (' ** anyone who can reach this address can use the proxy to '
+               'reach the network it is on')
+        if server.ca:
+            print (' ** and any device that trusts its CA will accept the '
+                   'proxy for every HTTPS site')
+    print 'Route a device through it with:'
+    print '  ezboot setup --proxy %s:%s' % (host, args.proxy_port)
+    if server.ca:
+        print 'Devices must trust %s; setup --proxy installs it.' % (
+            server.ca.ca_cert)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print
+    finally:
+        server.server_close()
 
 
 def get_b2g_distro(args):
@@ -548,8 +2890,24 @@ def flash_last_dl(args):
     dest = get_b2g_distro(args)
     show_build_info(args)
     with pushd(dest):
+        start = time.time()
         sh('./flash.sh')
 
+    if getattr(args, 'bench_boot', False):
+        print 'Timing boot'
+        flashed = time.time()
+        stages = time_boot(args, flashed)
+        stages['flash'] = flashed - start
+        save_boot_results(args, build_revisions(args), [stages])
+
+    if getattr(args, 'wifi_ssid', None):
+        try:
+            preseed_wifi(args)
+        except Exception, exc:
+            # Not fatal; setup can still configure WiFi.
+            print ' ** could not preseed WiFi: %s: %s' % (
+                exc.__class__.__name__, exc)
+
 
 def kill_all_apps(args):
     mc = get_marionette(args)
@@ -558,26 +2916,251 @@ def kill_all_apps(args):
     print 'Killed all apps'
 
 
-def do_recss(args):
-    mc = get_marionette(args)
-    # From : http://david.dojotoolkit.org/recss.html
-    js = """
-function _doReCSS() {
-    var i, a, s;
+# From : http://david.dojotoolkit.org/recss.html
+# When a list of file paths is passed as the first argument, only stylesheets
+# whose URL path ends with one of those paths are reloaded.
+RECSS_JS = """
+function _doReCSS(names) {
+    var i, j, a, s, path, reloaded = 0, matched = {};
     a = document.getElementsByTagName('link');
     for (i = 0; i < a.length; i++) {
         s = a[i];
         if (s.rel.toLowerCase().indexOf('stylesheet') >= 0 && s.href) {
             var h = s.href.replace(/(&|\\?)forceReload=\\d+/, '');
-            s.href = h + (h.indexOf('?') >= 0 ? '&' : '?') + 'forceReload=' + (new Date().valueOf())
+            if (names) {
+                path = '/' + h.split('#')[0].split('?')[0];
+                for (j = 0; j < names.length; j++) {
+                    if (path.substr(-(names[j].length + 1)) == '/' + names[j]) {
+                        break;
+                    }
+                }
+                if (j == names.length) {
+                    continue;
+                }
+                matched[names[j]] = true;
+            }
+            s.href = h + (h.indexOf('?') >= 0 ? '&' : '?') + 'forceReload=' + (new Date().valueOf());
+            reloaded++;
         }
     }
+    return {reloaded: reloaded, matched: Object.keys(matched)};
 };
-_doReCSS();
+return _doReCSS(arguments[0]);
+"""
+# Seconds between file system scans when inotify is not available.
+WATCH_POLL_INTERVAL = 0.25
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def scan_css(path):
+    """Returns a dict of relative path -> (mtime, size) for CSS files."""
+    found = {}
+    for root, dirs, files in os.walk(path):
+        for fn in files:
+            if not fn.endswith('.css'):
+                continue
+            full = os.path.join(root, fn)
+            try:
+                st = os.stat(full)
+            except OSError:
+                # Editors often replace files on save.
+                continue
+            found[os.path.relpath(full, path)] = (st.st_mtime, st.st_size)
+    return found
+
+
+class CSSPoller(object):
+    """Finds changed CSS files by scanning the tree."""
+
+    def __init__(self, path):
+        self.path = path
+        self.last = scan_css(path)
+
+    def changes(self, timeout=None):
+        """Returns the CSS files that changed, waiting up to timeout
+        seconds (or until something changes if timeout is None)."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            time.sleep(WATCH_POLL_INTERVAL)
+            current = scan_css(self.path)
+            diff = set(fn for fn, stat in current.items()
+                       if self.last.get(fn) != stat)
+            self.last = current
+            if diff or (deadline and time.time() >= deadline):
+                return diff
+
+    def close(self):
+        pass
+
+
+class CSSInotify(object):
+    """Finds changed CSS files with Linux inotify."""
+
+    def __init__(self, path):
+        libc_name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        # Raises AttributeError when there is no inotify, such as on Mac.
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int,
+                                                ctypes.c_char_p,
+                                                ctypes.c_uint32]
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self.path = path
+        self.dirs = {}
+        self.watch_tree(path)
+
+    def watch_tree(self, top):
+        for root, dirs, files in os.walk(top):
+            wd = self.libc.inotify_add_watch(
+                self.fd, root,
+                IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(),
+                              'Could not watch %s' % root)
+            self.dirs[wd] = root
+
+    def changes(self, timeout=None):
+        """Returns the CSS files that changed, waiting up to timeout
+        seconds (or until something changes if timeout is None)."""
+        readable, _, _ = select_module.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        buf = os.read(self.fd, 64 * 1024)
+        changed = set()
+        pos = 0
+        while pos < len(buf):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buf, pos)
+            pos += INOTIFY_EVENT.size
+            name = buf[pos:pos + length].rstrip('\0')
+            pos += length
+            if wd not in self.dirs:
+                # Queue overflow or a removed directory.
+                continue
+            full = os.path.join(self.dirs[wd], name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch_tree(full)
+                    changed.update(os.path.relpath(os.path.join(full, fn),
+                                                   self.path)
+                                   for fn in scan_css(full))
+            elif name.endswith('.css') and not mask & IN_CREATE:
+                # A new file is reported again when it is written.
+                changed.add(os.path.relpath(full, self.path))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watch_css(path, debounce):
+    """Yields sets of changed CSS files beneath path.
+
+    A burst of saves is collected until nothing has changed for
+    debounce seconds.
     """
+    try:
+        watcher = CSSInotify(path)
+    except (AttributeError, OSError, TypeError):
+        watcher = CSSPoller(path)
+    try:
+        while True:
+            changed = watcher.changes()
+            while True:
+                more = watcher.changes(debounce)
+                if not more:
+                    break
+                changed.update(more)
+            if changed:
+                yield changed
+    finally:
+        watcher.close()
+
+
+def recss_frames(mc, names, frame_cache):
+    """Reloads stylesheets matching names in the system and app frames.
+
+    frame_cache maps a file name to the mozapp manifests of the frames that
+    have been checked for it and of those where it was found, so that
+    repeated saves only visit those frames plus any newly opened apps.
+    """
+    mc.switch_to_frame()
+    reloaded = mc.execute_script(RECSS_JS,
+                                 script_args=[names])['reloaded']
+    manifests = mc.execute_script("""
+        var frames = document.querySelectorAll('iframe[mozapp]');
+        var manifests = [];
+        for (var i = 0; i < frames.length; i++) {
+            manifests.push(frames[i].getAttribute('mozapp'));
+        }
+        return manifests;
+        """)
+
+    for manifest in manifests:
+        todo = [n for n in names
+                if n not in frame_cache or
+                manifest in frame_cache[n]['found'] or
+                manifest not in frame_cache[n]['checked']]
+        if not todo:
+            continue
+        mc.switch_to_frame()
+        try:
+            frame = mc.find_element('css selector',
+                                    'iframe[mozapp="%s"]' % manifest)
+        except NoSuchElementException:
+            # The app closed while we were reloading.
+            continue
+        mc.switch_to_frame(frame)
+        res = mc.execute_script(RECSS_JS, script_args=[todo])
+        reloaded += res['reloaded']
+        for n in todo:
+            cache = frame_cache.setdefault(n, {'checked': set(),
+                                               'found': set()})
+            cache['checked'].add(manifest)
+            if n in res['matched']:
+                cache['found'].add(manifest)
+            else:
+                cache['found'].discard(manifest)
+
     mc.switch_to_frame()
-    mc.execute_script(js)
-    print 'Reset CSS'
+    return reloaded
+
+
+def do_recss(args):
+    mc = get_marionette(args)
+    if not args.watch:
+        mc.switch_to_frame()
+        mc.execute_script(RECSS_JS)
+        print 'Reset CSS'
+        return
+
+    watch_dir = os.path.abspath(os.path.expanduser(args.watch))
+    if not os.path.isdir(watch_dir):
+        args.error('Not a directory: %s' % watch_dir)
+    print 'Watching %s for CSS changes (^C to quit)' % watch_dir
+    frame_cache = {}
+    try:
+        for changed in watch_css(watch_dir, args.debounce / 1000.0):
+            names = sorted(fn.replace(os.sep, '/') for fn in changed)
+            start = time.time()
+            try:
+                count = recss_frames(mc, names, frame_cache)
+            except socket.error:
+                print ' ** lost connection to Marionette; reconnecting'
+                mc = get_marionette(args)
+                frame_cache.clear()
+                count = recss_frames(mc, names, frame_cache)
+            print 'Reloaded %s stylesheet(s) for %s in %dms' % (
+                count, ', '.join(names), (time.time() - start) * 1000)
+    except KeyboardInterrupt:
+        print
+    finally:
+        mc.delete_session()
 
 
 def show_build_info(args):
@@ -609,19 +3192,388 @@ def show_build_info(args):
         print ' ** could not get build info'
 
 
-def do_login(args):
+def build_revisions(args):
+    """Returns the gecko/gaia revisions of the last downloaded build.
+
+    Returns an empty dict when there is no build info.
+    """
+    path = os.path.join(args.work_dir, 'last-build', 'b2g-distro',
+                        'sources.xml')
+    revisions = {}
+    try:
+        root = ET.parse(path).getroot()
+    except (IOError, ET.ParseError):
+        return revisions
+    for pj in ('gecko', 'gaia'):
+        for el in root.findall("./project[@path='%s']" % pj):
+            revisions[pj] = el.attrib['revision']
+    return revisions
+
+
+def build_label(revisions):
+    if not revisions:
+        return 'unknown build'
+    return ' '.join('%s:%s' % (pj, revisions[pj][:12])
+                    for pj in sorted(revisions))
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(rank, 0)]
+
+
+def bench_results_path(args, name):
+    return os.path.join(args.work_dir, 'bench', '%s.json' % name)
+
+
+def load_bench_results(args, name):
+    path = bench_results_path(args, name)
+    if not os.path.exists(path):
+        return []
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def save_bench_result(args, name, result):
+    """Appends a result, tagged with the current build, to the history."""
+    path = bench_results_path(args, name)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    results = load_bench_results(args, name)
+    results.append(result)
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    os.rename(tmp, path)
+
+
+def find_baseline(results, build, baseline=None):
+    """Returns the results of the build to compare against.
+
+    This is the most recent other build in the history unless baseline
+    names a gecko or gaia revision prefix.
+    """
+    label = build_label(build)
+    for result in reversed(results):
+        other = result['build']
+        if baseline:
+            if not any(rev.startswith(baseline) for rev in other.values()):
+                continue
+        elif build_label(other) == label:
+            continue
+        return [r for r in results
+                if build_label(r['build']) == build_label(other)]
+    return []
+
+
+def print_bench_table(rows, baseline_build):
+    """Prints (name, current, baseline, format) rows side by side."""
+    if baseline_build is None:
+        print '%-22s %12s' % ('', 'this build')
+    else:
+        print '%-22s %12s %12s %8s' % ('', 'this build', 'baseline',
+                                        'change')
+    for name, current, base, fmt in rows:
+        if baseline_build is None or base is None:
+            print '%-22s %12s' % (name, fmt % current)
+            continue
+        change = ''
+        if base:
+            change = '%+.1f%%' % ((current - base) * 100.0 / base)
+        print '%-22s %12s %12s %8s' % (name, fmt % current, fmt % base,
+                                        change)
+    if baseline_build is not None:
+        print 'Baseline: %s' % build_label(baseline_build)
+
+
+FPS_PREFS = {'layers.acceleration.draw-fps': True}
+# A frame that took longer than this missed at least one vsync.
+JANK_FRAME_MS = 1000.0 / 60 * 1.5
+# Runs in the app frame. Scrolls the element with the most scrollable
+# content back and forth once per animation frame and reports the
+# intervals between frames along with the number of paints.
+SCROLL_FPS_JS = """
+var duration = arguments[0], step = arguments[1];
+var raf = window.requestAnimationFrame || window.mozRequestAnimationFrame;
+var scroller = null, room = 0;
+var all = document.querySelectorAll('*');
+for (var i = 0; i < all.length; i++) {
+    var el = all[i], space = el.scrollHeight - el.clientHeight;
+    if (space > room) {
+        var overflow = window.getComputedStyle(el).overflowY;
+        if (overflow == 'auto' || overflow == 'scroll' ||
+                el == document.documentElement || el == document.body) {
+            scroller = el;
+            room = space;
+        }
+    }
+}
+if (!scroller) {
+    marionetteScriptFinished({error: 'nothing to scroll in this app'});
+    return;
+}
+var direction = 1, start = null, last = null, intervals = [];
+var paints = window.mozPaintCount;
+function frame(now) {
+    now = now || Date.now();
+    if (last === null) {
+        start = now;
+    } else {
+        intervals.push(now - last);
+    }
+    last = now;
+    var top = scroller.scrollTop + direction * step;
+    if (top <= 0 || top >= room) {
+        direction = -direction;
+    }
+    scroller.scrollTop = top;
+    if (now - start < duration) {
+        raf(frame);
+    } else {
+        marionetteScriptFinished({
+            intervals: intervals,
+            paints: window.mozPaintCount - paints,
+            scroller: scroller.id || scroller.tagName.toLowerCase()
+        });
+    }
+}
+raf(frame);
+"""
+
+
+def measure_scroll_fps(args):
     mc = get_marionette(args)
-    device = GaiaDevice(mc)
-    apps = GaiaApps(mc)
-    data_layer = GaiaData(mc)
+    try:
+        apps = GaiaApps(mc)
+        apps.kill_all()
+        apps.launch(args.app)
+        # Let the launch animation and first paint settle.
+        time.sleep(2)
+        mc.set_script_timeout((args.duration + 10) * 1000)
+        res = mc.execute_async_script(SCROLL_FPS_JS, script_args=[
+            args.duration * 1000, args.scroll_step])
+    finally:
+        mc.client.close()
+    if res.get('error'):
+        args.error(res['error'])
+    return res
+
+
+def do_bench_fps(args):
+    build = build_revisions(args)
+    print 'Benchmarking %s scrolling on %s' % (args.app, build_label(build))
+    failed = apply_prefs(args, FPS_PREFS)
+    if failed:
+        print ' ** could not turn on the FPS counter: %s' % ', '.join(failed)
+    try:
+        res = measure_scroll_fps(args)
+    finally:
+        apply_prefs(args, {}, cleared=FPS_PREFS.keys())
+
+    intervals = res['intervals']
+    if not intervals:
+        args.error('No frames were recorded')
+    elapsed = sum(intervals) / 1000.0
+    result = {
+        'build': build,
+        'time': int(time.time()),
+        'app': args.app,
+        'scroller': res['scroller'],
+        'frames': len(intervals),
+        'mean_fps': len(intervals) / elapsed,
+        'paint_fps': res['paints'] / elapsed,
+        'jank_frames': len([i for i in intervals if i > JANK_FRAME_MS]),
+        'p99_frame_ms': percentile(intervals, 99),
+        'max_frame_ms': max(intervals),
+    }
+
+    history = [r for r in load_bench_results(args, 'fps')
+               if r['app'].lower() == args.app.lower()]
+    baseline = find_baseline(history, build, baseline=args.baseline)
+    save_bench_result(args, 'fps', result)
+
+    print 'Scrolled <%s> for %s frames' % (result['scroller'],
+                                           result['frames'])
+    rows = []
+    for key, name, fmt in (('mean_fps', 'mean FPS', '%.1f'),
+                           ('paint_fps', 'paints/s', '%.1f'),
+                           ('jank_frames', 'jank frames', '%d'),
+                           ('p99_frame_ms', 'p99 frame (ms)', '%.1f'),
+                           ('max_frame_ms', 'max frame (ms)', '%.1f')):
+        base = None
+        if baseline:
+            base = (sum(r[key] for r in baseline) /
+                    float(len(baseline)))
+        rows.append((name, result[key], base, fmt))
+    print_bench_table(rows, baseline[-1]['build'] if baseline else None)
+    if not baseline:
+        print 'No baseline yet; results saved for the next build.'
+
+
+BOOT_STAGES = (('flash', 'flash end'),
+               ('adb', 'adb visible'),
+               ('b2g', 'b2g process up'),
+               ('marionette', 'Marionette port'),
+               ('homescreen', 'homescreen loaded'))
+BOOT_TIMEOUT = 300  # seconds
+# Returns the homescreen (or first run) app frame once the system app
+# has created it.
+HOMESCREEN_FRAME_JS = """
+function findHome() {
+    var frames = document.querySelectorAll('iframe[mozbrowser]');
+    for (var i = 0; i < frames.length; i++) {
+        var src = frames[i].getAttribute('src') || '';
+        if (src.indexOf('homescreen') != -1 || src.indexOf('ftu') != -1) {
+            return frames[i];
+        }
+    }
+    return null;
+}
+(function wait() {
+    var frame = findHome();
+    if (frame) {
+        marionetteScriptFinished(frame);
+    } else {
+        setTimeout(wait, 100);
+    }
+})();
+"""
+# Runs inside the homescreen frame and finishes when its document has
+# loaded, which is when the system app sees mozbrowserloadend.
+HOMESCREEN_LOADED_JS = """
+if (document.readyState == 'complete') {
+    marionetteScriptFinished(true);
+} else {
+    window.addEventListener('load', function() {
+        marionetteScriptFinished(true);
+    });
+}
+"""
 
-    _persona_frame_locator = ('css selector', "iframe")
+
+def b2g_running():
+    try:
+        return bool(b2g_pids())
+    except subprocess.CalledProcessError:
+        # The device dropped off adb while booting.
+        return False
+
+
+def marionette_accepting(port):
+    """True if the Marionette server answered on the forwarded port.
+
+    adb accepts connections to a forwarded port even when nothing is
+    listening on the device so wait for the server's greeting.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.settimeout(1)
+    try:
+        sock.connect(('localhost', port))
+        return bool(sock.recv(64))
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+def device_offline():
+    try:
+        return sh_output('adb get-state').strip() != 'device'
+    except subprocess.CalledProcessError:
+        return True
+
+
+def time_boot(args, start, wait_offline=False):
+    """Returns the seconds from start until each boot stage was reached."""
+    stages = {}
+
+    def reached(stage, check):
+        while not check():
+            if time.time() - start > BOOT_TIMEOUT:
+                args.error('The device did not reach "%s" within %ss'
+                           % (dict(BOOT_STAGES)[stage], BOOT_TIMEOUT))
+            time.sleep(0.2)
+        stages[stage] = time.time() - start
+        print '  %-20s %6.1fs' % (dict(BOOT_STAGES)[stage], stages[stage])
+
+    if wait_offline:
+        # adb reboot returns before the device goes away.
+        while not device_offline() and time.time() - start < 30:
+            time.sleep(0.2)
+    reached('adb', lambda: sh('adb wait-for-device') == 0)
+    reached('b2g', b2g_running)
+    sh('adb forward tcp:%s tcp:%s' % (args.adb_port, args.adb_port))
+    reached('marionette', lambda: marionette_accepting(args.adb_port))
+
+    def homescreen_loaded():
+        mc = get_marionette(args)
+        try:
+            mc.set_script_timeout(
+                int(max(BOOT_TIMEOUT - (time.time() - start), 1) * 1000))
+            frame = mc.execute_async_script(HOMESCREEN_FRAME_JS)
+            mc.switch_to_frame(frame)
+            return mc.execute_async_script(HOMESCREEN_LOADED_JS)
+        except (TimeoutException, NoSuchElementException,
+                StaleElementException):
+            # Timed out, or the frame went away when first run finished.
+            return False
+        finally:
+            mc.client.close()
+
+    reached('homescreen', homescreen_loaded)
+    return stages
+
+
+def save_boot_results(args, build, runs):
+    """Stores each boot and prints percentiles against the baseline."""
+    history = load_bench_results(args, 'boot')
+    for stages in runs:
+        save_bench_result(args, 'boot', {'build': build,
+                                         'time': int(time.time()),
+                                         'stages': stages})
+    baseline = find_baseline(history, build,
+                             baseline=getattr(args, 'baseline', None))
+
+    print 'Boot times for %s over %s run(s), in seconds:' % (
+        build_label(build), len(runs))
+    rows = []
+    for stage, name in BOOT_STAGES:
+        current = [r[stage] for r in runs if stage in r]
+        if not current:
+            continue
+        base = [r['stages'][stage] for r in baseline
+                if stage in r['stages']]
+        for pct in (50, 90):
+            rows.append(('%s p%s' % (name, pct), percentile(current, pct),
+                         percentile(base, pct), '%.1f'))
+    print_bench_table(rows, baseline[-1]['build'] if baseline else None)
+    if not baseline:
+        print 'No baseline yet; results saved for the next build.'
+
+
+def do_bench_boot(args):
+    build = build_revisions(args)
+    runs = []
+    for i in range(args.n):
+        print 'Boot %s of %s' % (i + 1, args.n)
+        start = time.time()
+        sh('adb reboot')
+        runs.append(time_boot(args, start, wait_offline=True))
+    save_boot_results(args, build, runs)
+
+
+def do_login(args):
+    mc = get_marionette(args)
 
     # Trusty UI on home screen
-    _tui_container_locator = ('id', 'trustedui-frame-container')
+    _persona_frame_locator = ('css selector',
+                              '#trustedui-frame-container iframe')
 
     # Persona dialog
-    _waiting_locator = ('css selector', 'body.waiting')
     _email_input_locator = ('id', 'authentication_email')
     _password_input_locator = ('id', 'authentication_password')
     _new_password = ('id', 'password')
@@ -629,21 +3581,13 @@ def do_login(args):
     _next_button_locator = ('css selector', 'button.start')
     _verify_start_button = ('css selector', 'button#verify_user')
     _returning_button_locator = ('css selector', 'button.returning')
-    _sign_in_button_locator = ('id', 'signInButton')
-    _this_session_only_button_locator = ('id', 'this_is_not_my_computer')
 
     # Switch to top level frame then Persona frame
     mc.switch_to_frame()
-    wait_for_element_present(mc, *_tui_container_locator)
-    trustyUI = mc.find_element(*_tui_container_locator)
-    wait_for_condition(mc, lambda m: trustyUI.find_element(*_persona_frame_locator))
-    personaDialog = trustyUI.find_element(*_persona_frame_locator)
-    mc.switch_to_frame(personaDialog)
+    run_batch(mc, [('wait_present', _persona_frame_locator)])
+    mc.switch_to_frame(mc.find_element(*_persona_frame_locator))
 
-    try:
-        ready = mc.find_element(*_email_input_locator).is_displayed()
-    except NoSuchElementException:
-        ready = False
+    ready, = run_batch(mc, [('is_displayed', _email_input_locator)]).values
     if not ready:
         print 'Persona email input is not present.'
         print 'Are you on a new login screen?'
@@ -656,72 +3600,105 @@ def do_login(args):
         if user_agrees():
             done = True
 
-    email_field = mc.find_element(*_email_input_locator)
-    email_field.send_keys(username)
-
-    #mc.tap(mc.find_element(*_next_button_locator)) #.click()
-    mc.find_element(*_next_button_locator).click()
-
-    try:
-        wait_for_element_displayed(mc, *_new_password)
+    result = run_batch(mc, [
+        ('send_keys', _email_input_locator, username),
+        ('tap', _next_button_locator),
+        ('wait_any', [_new_password, _password_input_locator]),
+    ])
+    if result.values[-1] == 0:
         # Creating a new account:
-        password_field = mc.find_element(*_new_password)
-        password_field.send_keys(password)
-        v_password = mc.find_element(*_verify_new_password)
-        v_password.send_keys(password)
-        wait_for_element_displayed(mc, *_verify_start_button)
-        mc.find_element(*_verify_start_button).tap()
-    except TimeoutException:
-        print 'Not a new account? Trying to log in to existing account'
-        # Logging into an exisiting account:
-        password_field = mc.find_element(*_password_input_locator)
-        password_field.send_keys(password)
-        wait_for_element_displayed(mc, *_returning_button_locator)
-        mc.find_element(*_returning_button_locator).tap() #.click()
+        run_batch(mc, [
+            ('send_keys', _new_password, password),
+            ('send_keys', _verify_new_password, password),
+            ('tap', _verify_start_button),
+        ])
+    else:
+        print 'Not a new account. Logging in to existing account'
+        run_batch(mc, [
+            ('send_keys', _password_input_locator, password),
+            ('tap', _returning_button_locator),
+        ])
 
     print 'You should be logged in now'
 
 
+TRUSTED_SERVERS = ('https://marketplace-dev.allizom.org,'
+                   'https://marketplace.firefox.com')
+
+
+def update_certs_repo(args, path):
+    """Clones or pulls marketplace-certs unless it was pulled recently."""
+    stamp = os.path.join(path, '.git', 'ezboot-last-pull')
+    if not os.path.exists(path):
+        print 'Cloning certificates for the first itme.'
+        sh('git clone https://github.com/briansmith/'
+           'marketplace-certs.git %s' % path)
+    elif (os.path.exists(stamp) and time.time() - os.path.getmtime(stamp)
+            < args.certs_max_age * 3600):
+        print 'Certificates were updated less than %s hours ago.' % (
+            args.certs_max_age)
+        return
+    else:
+        # pull the latest changes from remote
+        print 'Updating certificates from remote.'
+        with pushd(path):
+            sh('git pull')
+    with open(stamp, 'w'):
+        pass
+
+
 def setup_certs(args):
-    device_id = args.flash_device_id
+    device_ids = as_list(args.device_ids) or [args.flash_device_id]
 
     # The device string for unagis is fixed.
-    if args.flash_device.lower() == 'unagi' and not device_id:
-        device_id = 'full_unagi'
+    if (args.flash_device and args.flash_device.lower() == 'unagi' and
+            device_ids == [None]):
+        device_ids = ['full_unagi']
 
     # Check connected devices to be sure.
     devices = sh_output('adb devices -l')
 
-    if not device_id or device_id not in devices:
-        raise ValueError('Check your device string using '
-                         '"adb devices -l" and put it in your '
-                         'ini file as flash_device_id. if you have '
-                         'problems use the string prefixed with '
-                         '"usb:"')
+    for device_id in device_ids:
+        if not device_id or device_id not in devices:
+            raise ValueError('Check your device string using '
+                             '"adb devices -l" and put it in your '
+                             'ini file as flash_device_id. if you have '
+                             'problems use the string prefixed with '
+                             '"usb:"')
 
     def setup_dev():
         certs_path = os.path.abspath(args.certs_path)
+        repo = os.path.join(args.work_dir, 'marketplace-certs')
+        update_certs_repo(args, repo)
 
-        with pushd(args.work_dir):
-            path = 'marketplace-certs'
-
-            if not os.path.exists(path):
-                print 'Cloning certificates for the first itme.'
-                sh('git clone https://github.com/briansmith/'
-                   'marketplace-certs.git %s'
-                   % os.path.join(args.work_dir, path))
-            else:
-                # pull the latest changes from remote
-                print 'Updating certificates from remote.'
-                with pushd(path):
-                    sh('git pull')
-
-            with pushd(path):
-                sh("./change_trusted_servers.sh '%s' "
-                   "'https://marketplace-dev.allizom.org,"
-                   "https://marketplace.firefox.com'" % device_id)
-                sh("./push_certdb.sh '%s' %s" %  (device_id, certs_path))
-            sh('adb reboot')
+        def push(device_id):
+            # The scripts write temporary files next to themselves and into
+            # the certdb so each device gets its own copy of both.
+            td = tempfile.mkdtemp()
+            try:
+                scripts = os.path.join(td, 'marketplace-certs')
+                certdb = os.path.join(td, 'certdb')
+                shutil.copytree(repo, scripts,
+                                ignore=shutil.ignore_patterns('.git'))
+                shutil.copytree(certs_path, certdb)
+                # Use cwd instead of pushd because this runs in threads.
+                check_call("./change_trusted_servers.sh '%s' '%s'"
+                           % (device_id, TRUSTED_SERVERS),
+                           shell=True, cwd=scripts)
+                check_call("./push_certdb.sh '%s' %s" % (device_id, certdb),
+                           shell=True, cwd=scripts)
+                if len(device_ids) == 1:
+                    sh('adb reboot')
+                else:
+                    sh("adb -s '%s' reboot" % device_id)
+            finally:
+                shutil.rmtree(td)
+
+        errors = run_per_device(push, device_ids)
+        for device_id, exc in errors:
+            print ' ** failed to install certs on %s: %s' % (device_id, exc)
+        if errors:
+            sys.exit(1)
 
     if args.env is None:
         args.error('Provide which version of dev certs you want to install. '
@@ -759,9 +3736,9 @@ def install_app(args):
     def confirm_installation():
         _yes_button_locator = ('id', 'app-install-install-button')
 
-        wait_for_element_displayed(mc, *_yes_button_locator)
-        mc.find_element(*_yes_button_locator).tap()
-        wait_for_element_not_displayed(mc, *_yes_button_locator)
+        run_batch(mc, [('wait_displayed', _yes_button_locator),
+                       ('tap', _yes_button_locator),
+                       ('wait_not_displayed', _yes_button_locator)])
 
         print 'App successfully installed.'
 
@@ -841,13 +3818,605 @@ def install_app(args):
             args.error('Error: App not found.')
     else:
         _install_button_locator = ('css selector', '.button.product.install')
-        marketplace.wait_for_element_displayed(*_install_button_locator)
-        mc.find_element(*_install_button_locator).tap()
+        run_batch(mc, [('tap', _install_button_locator)])
         mc.switch_to_frame()
 
     confirm_installation()
 
 
+def local_sync_manifest(args, local_dir):
+    """Returns a dict of relative path -> md5 for all files in local_dir.
+
+    Hashes are cached in work_dir by mtime and size so that unchanged files
+    are not read again.
+    """
+    cache_dir = os.path.join(args.work_dir, 'sync')
+    if not os.path.exists(cache_dir):
+        os.mkdir(cache_dir)
+    cache_file = os.path.join(cache_dir, '%s.json'
+                              % hashlib.md5(local_dir).hexdigest())
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as fp:
+            cache = json.load(fp)
+
+    stats = {}
+    for root, dirs, files in os.walk(local_dir):
+        for fn in files:
+            full = os.path.join(root, fn)
+            rel = os.path.relpath(full, local_dir).replace(os.sep, '/')
+            st = os.stat(full)
+            mtime, size, digest = cache.get(rel, (None, None, None))
+            if (mtime, size) != (st.st_mtime, st.st_size):
+                digest = md5_file(full)
+            stats[rel] = (st.st_mtime, st.st_size, digest)
+
+    with open(cache_file, 'w') as fp:
+        json.dump(stats, fp)
+    return dict((rel, st[2]) for rel, st in stats.items())
+
+
+def device_sync_manifest(device_manifest):
+    out, rc = adb_shell('cat %s' % pipes.quote(device_manifest))
+    if rc != 0:
+        return {}
+    try:
+        return json.loads(out)
+    except ValueError:
+        print ' ** ignoring corrupt manifest %s' % device_manifest
+        return {}
+
+
+def device_sync_files(device_path):
+    """Returns {relative path: (size, mtime)} for files on the device."""
+    try:
+        listing = list(device_ls(device_path))
+    except ValueError:
+        # Nothing was synced there yet.
+        return {}
+    prefix = device_path + '/'
+    return dict((path[len(prefix):], (size, mtime))
+                for path, kind, perms, owner, group, size, mtime in listing
+                if kind == '-' and path.startswith(prefix))
+
+
+def push_sync_files(local_dir, device_path, changed):
+    if len(changed) == 1:
+        sh('adb push %s %s' % (
+            pipes.quote(os.path.join(local_dir, changed[0])),
+            pipes.quote('%s/%s' % (device_path, changed[0]))))
+        return
+
+    device_tar = '/data/local/tmp/ezboot-sync.tar'
+    td = tempfile.mkdtemp()
+    try:
+        local_tar = os.path.join(td, 'sync.tar')
+        with tarfile.open(local_tar, 'w') as tar:
+            for rel in changed:
+                tar.add(os.path.join(local_dir, rel), arcname=rel)
+        sh('adb push %s %s' % (local_tar, device_tar))
+    finally:
+        shutil.rmtree(td)
+
+    out, rc = adb_shell('mkdir -p {dest} && cd {dest} && tar -xf {tar}; '
+                        'st=$?; rm {tar}; test $st -eq 0'.format(
+                            dest=pipes.quote(device_path), tar=device_tar))
+    if rc != 0:
+        print ' ** tar failed on device (%s); pushing files one by one' % (
+            out.strip() or rc)
+        for rel in changed:
+            sh('adb push %s %s' % (
+                pipes.quote(os.path.join(local_dir, rel)),
+                pipes.quote('%s/%s' % (device_path, rel))))
+
+
+def restart_app(args, name):
+    mc = get_marionette(args)
+    apps = GaiaApps(mc)
+    for app in apps.running_apps:
+        if app.name.lower() == name.lower():
+            apps.kill(app)
+    apps.launch(name)
+    mc.client.close()
+    print 'Restarted %s' % name
+
+
+def do_sync(args):
+    local_dir = os.path.abspath(os.path.expanduser(args.local_dir))
+    if not os.path.isdir(local_dir):
+        args.error('Not a directory: %s' % local_dir)
+    device_path = args.device_path.rstrip('/')
+    device_manifest = '/data/local/tmp/ezboot-sync-%s.json' % (
+        hashlib.md5(device_path).hexdigest())
+
+    start = time.time()
+    local = local_sync_manifest(args, local_dir)
+    # The manifest records the size and ls time of each file we pushed.
+    # Anything else that changed a file on the device (an app update, a
+    # manual adb push) shows up as a difference from the listing.
+    remote = device_sync_manifest(device_manifest)
+    on_device = device_sync_files(device_path)
+    changed = sorted(rel for rel, digest in local.items()
+                     if rel not in on_device or
+                     remote.get(rel) != [digest] + list(on_device[rel]))
+    removed = sorted(rel for rel in remote
+                     if rel not in local and rel in on_device)
+
+    if not changed and not removed:
+        print 'Nothing to sync'
+        return
+
+    if changed:
+        print 'Pushing %s changed file(s)' % len(changed)
+        push_sync_files(local_dir, device_path, changed)
+
+    # Keep the command line short enough for the device shell.
+    for i in range(0, len(removed), 50):
+        batch = removed[i:i + 50]
+        print 'Deleting %s' % ', '.join(batch)
+        adb_shell('cd %s && rm %s' % (pipes.quote(device_path),
+                                      ' '.join(pipes.quote(rel)
+                                               for rel in batch)))
+
+    on_device = device_sync_files(device_path)
+    manifest = dict((rel, [digest] + list(on_device[rel]))
+                    for rel, digest in local.items() if rel in on_device)
+    fd, tmp = tempfile.mkstemp(suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(manifest, fp)
+        sh('adb push %s %s' % (tmp, device_manifest))
+    finally:
+        os.unlink(tmp)
+    print 'Synced in %.2fs' % (time.time() - start)
+
+    if args.restart_app:
+        restart_app(args, args.restart_app)
+
+
+SNAPSHOT_DIRS = ('/data/local', '/data/b2g/mozilla', '/data/misc/wifi')
+# Scratch space for ezboot and others; never part of a snapshot.
+SNAPSHOT_SKIP = ('/data/local/tmp',)
+
+
+def ls_mode(perms):
+    """Converts an ls permission string like rwxr-s--- to a mode."""
+    mode = 0
+    for i, ch in enumerate(perms):
+        if ch not in '-ST':
+            mode |= 1 << (8 - i)
+    for i, bit in ((2, 0o4000), (5, 0o2000), (8, 0o1000)):
+        if perms[i] in 'sStT':
+            mode |= bit
+    return mode
+
+
+def snapshot_skipped(path):
+    return any(path == skip or path.startswith(skip + '/')
+               for skip in SNAPSHOT_SKIP)
+
+
+def device_file_modes(root):
+    """Returns {path: (type, owner, group, mode)} for everything in root."""
+    entries = {}
+    for path, kind, perms, owner, group, size, mtime in device_ls(root):
+        if kind == 'l':
+            # Symlinks are recreated by whatever created them.
+            continue
+        if not snapshot_skipped(path):
+            entries[path] = ('dir' if kind == 'd' else 'file', owner, group,
+                             ls_mode(perms))
+    return entries
+
+
+def store_object(store, path):
+    """Adds a file to the content addressed store.
+
+    Returns (sha1, True if the object is new).
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(DOWNLOAD_BUFFER_SIZE), ''):
+            digest.update(chunk)
+    sha1 = digest.hexdigest()
+    obj = os.path.join(store, sha1[:2], sha1[2:])
+    if os.path.exists(obj):
+        return sha1, False
+    if not os.path.exists(os.path.dirname(obj)):
+        os.makedirs(os.path.dirname(obj))
+    compressor = zlib.compressobj()
+    with open(path, 'rb') as src:
+        with open(obj + '.tmp', 'wb') as dest:
+            for chunk in iter(lambda: src.read(DOWNLOAD_BUFFER_SIZE), ''):
+                dest.write(compressor.compress(chunk))
+            dest.write(compressor.flush())
+    os.rename(obj + '.tmp', obj)
+    return sha1, True
+
+
+def extract_object(store, sha1, path):
+    decompressor = zlib.decompressobj()
+    with open(os.path.join(store, sha1[:2], sha1[2:]), 'rb') as src:
+        with open(path, 'wb') as dest:
+            for chunk in iter(lambda: src.read(DOWNLOAD_BUFFER_SIZE), ''):
+                dest.write(decompressor.decompress(chunk))
+            dest.write(decompressor.flush())
+
+
+def snapshot_manifest_path(args, name):
+    if not re.match(r'^[\w.-]+$', name):
+        args.error('Snapshot names can only have letters, numbers, '
+                   'dots, dashes and underscores')
+    return os.path.join(args.work_dir, 'snapshots', '%s.json' % name)
+
+
+def do_snapshot(args):
+    manifest_path = snapshot_manifest_path(args, args.name)
+    store = os.path.join(args.work_dir, 'snapshots', 'objects')
+    if not os.path.exists(store):
+        os.makedirs(store)
+
+    sh('adb wait-for-device')
+    print 'Stopping b2g to take a consistent snapshot'
+    sh('adb shell stop b2g')
+    td = tempfile.mkdtemp()
+    entries = {}
+    try:
+        for root in SNAPSHOT_DIRS:
+            modes = device_file_modes(root)
+            entries.update(modes)
+            os.makedirs(td + root)
+            # Pull each child on its own so that skipped ones such as
+            # /data/local/tmp are never copied.
+            for path in sorted(modes):
+                if os.path.dirname(path) == root:
+                    sh('adb pull %s %s' % (pipes.quote(path),
+                                           pipes.quote(td + path)))
+    finally:
+        sh('adb shell start b2g')
+
+    stored_entries = {}
+    try:
+        files = new = size = stored = 0
+        for path, (kind, owner, group, mode) in entries.items():
+            entry = {'type': kind, 'owner': owner, 'group': group,
+                     'mode': mode}
+            local = td + path
+            if kind == 'file':
+                if not os.path.isfile(local):
+                    print ' ** could not pull %s' % path
+                    continue
+                entry['object'], created = store_object(store, local)
+                files += 1
+                size += os.path.getsize(local)
+                if created:
+                    new += 1
+                    stored += os.path.getsize(os.path.join(
+                        store, entry['object'][:2], entry['object'][2:]))
+            stored_entries[path] = entry
+    finally:
+        shutil.rmtree(td)
+
+    manifest = {'name': args.name, 'time': int(time.time()),
+                'build': build_revisions(args), 'roots': SNAPSHOT_DIRS,
+                'entries': stored_entries}
+    with open(manifest_path + '.tmp', 'w') as fp:
+        json.dump(manifest, fp, indent=2, sort_keys=True)
+    os.rename(manifest_path + '.tmp', manifest_path)
+    print 'Saved snapshot %s: %s files, %.1fMB (%s new, %.1fMB compressed)' % (
+        args.name, files, size / 1024.0 / 1024.0, new,
+        stored / 1024.0 / 1024.0)
+
+
+def do_restore(args):
+    manifest_path = snapshot_manifest_path(args, args.name)
+    if not os.path.exists(manifest_path):
+        snapshot_dir = os.path.dirname(manifest_path)
+        names = []
+        if os.path.exists(snapshot_dir):
+            names = sorted(fn[:-len('.json')] for fn in
+                           os.listdir(snapshot_dir) if fn.endswith('.json'))
+        args.error('No snapshot named %s. Snapshots: %s'
+                   % (args.name, ', '.join(names) or 'none'))
+    with open(manifest_path) as fp:
+        manifest = json.load(fp)
+    store = os.path.join(args.work_dir, 'snapshots', 'objects')
+
+    build = build_revisions(args)
+    if manifest['build'] and build and manifest['build'] != build:
+        print ' ** snapshot %s was taken on %s but the last build is %s' % (
+            args.name, build_label(manifest['build']), build_label(build))
+
+    device_ids = as_list(args.device_ids) or [None]
+
+    td = tempfile.mkdtemp()
+    try:
+        # Rebuild the tree once then push each root in one go.
+        script = []
+        for path in sorted(manifest['entries']):
+            entry = manifest['entries'][path]
+            local = td + path
+            if entry['type'] == 'dir':
+                if not os.path.exists(local):
+                    os.makedirs(local)
+            else:
+                if not os.path.exists(os.path.dirname(local)):
+                    os.makedirs(os.path.dirname(local))
+                extract_object(store, entry['object'], local)
+            script.append('chown %s.%s %s' % (entry['owner'], entry['group'],
+                                              pipes.quote(path)))
+            script.append('chmod %o %s' % (entry['mode'], pipes.quote(path)))
+        for root in manifest['roots']:
+            if not os.path.exists(td + root):
+                os.makedirs(td + root)
+        with open(os.path.join(td, 'restore.sh'), 'w') as fp:
+            fp.write('\n'.join(script) + '\n')
+
+        def restore(device_id):
+            adb = 'adb -s %s' % pipes.quote(device_id) if device_id else 'adb'
+            device_script = '/data/local/tmp/ezboot-restore.sh'
+            check_call('%s wait-for-device' % adb, shell=True)
+            check_call('%s shell stop b2g' % adb, shell=True)
+            for root in manifest['roots']:
+                clear = ('for f in %s/*; do case "$f" in %s) ;; '
+                         '*) [ -e "$f" ] && rm -r "$f";; esac; done' % (
+                             root, '|'.join(SNAPSHOT_SKIP)))
+                check_call('%s shell %s' % (adb, pipes.quote(clear)),
+                           shell=True)
+                check_call('%s push %s %s' % (
+                    adb, pipes.quote(td + root), root), shell=True)
+            check_call('%s push %s %s' % (
+                adb, pipes.quote(os.path.join(td, 'restore.sh')),
+                device_script), shell=True)
+            check_call('%s shell sh %s' % (adb, device_script), shell=True)
+            check_call('%s shell rm %s' % (adb, device_script), shell=True)
+            check_call('%s reboot' % adb, shell=True)
+
+        errors = run_per_device(restore, device_ids)
+    finally:
+        shutil.rmtree(td)
+
+    for device_id, exc in errors:
+        print ' ** failed to restore %s: %s' % (device_id or 'device', exc)
+    if errors:
+        sys.exit(1)
+    print 'Restored %s to %s device(s). They are rebooting.' % (
+        args.name, len(device_ids))
+
+
+class PlanStep(object):
+
+    def __init__(self, name, command, needs, inputs, options):
+        self.name = name
+        self.command = command
+        self.needs = needs
+        self.inputs = inputs
+        self.options = options
+        self.fingerprint = None
+
+
+def load_plan(args, path):
+    """Returns an OrderedDict of step name -> PlanStep in dependency order."""
+    config = ConfigParser.SafeConfigParser()
+    if not config.read([path]):
+        args.error('Could not read plan %s' % path)
+
+    steps = {}
+    for name in config.sections():
+        options = OrderedDict(config.items(name))
+        command = options.pop('command', name)
+        needs = options.pop('needs', '').split()
+        inputs = options.pop('inputs', '').split()
+        steps[name] = PlanStep(name, command, needs, inputs, options)
+
+    ordered = OrderedDict()
+    visiting = set()
+
+    def visit(name, parent):
+        if name not in steps:
+            args.error('Step %r needs unknown step %r' % (parent, name))
+        if name in ordered:
+            return
+        if name in visiting:
+            args.error('Steps %s depend on each other'
+                       % ', '.join(sorted(visiting)))
+        visiting.add(name)
+        for dep in steps[name].needs:
+            visit(dep, name)
+        visiting.remove(name)
+        ordered[name] = steps[name]
+
+    for name in config.sections():
+        visit(name, None)
+    return ordered
+
+
+def step_fingerprint(step, plan):
+    """Returns a hash of everything that would make a step do new work."""
+    digest = hashlib.sha1()
+    digest.update(json.dumps([step.command, step.options.items(),
+                              [plan[dep].fingerprint for dep in step.needs]]))
+
+    inputs = list(step.inputs)
+    if step.command == 'flash':
+        url = step.options.get('flash_url') or DEFAULT_BUILD_URLS.get(
+            step.options.get('flash_device', '').lower())
+        if url:
+            inputs.append(url)
+    if step.command == 'setup':
+        inputs.append(step.options.get('custom_prefs') or
+                      os.path.join(os.getcwd(), 'ezboot', 'custom-prefs.js'))
+
+    for value in inputs:
+        if value.startswith('http://') or value.startswith('https://'):
+            auth = None
+            if step.options.get('flash_user'):
+                auth = HTTPBasicAuth(step.options['flash_user'],
+                                     step.options.get('flash_pass'))
+            res = requests.head(value, auth=auth, allow_redirects=True)
+            if res.status_code != 200:
+                # Can't tell if it changed so make sure the step runs.
+                digest.update(str(time.time()))
+            else:
+                digest.update(upstream_version(res))
+        elif os.path.isfile(os.path.expanduser(value)):
+            digest.update(md5_file(os.path.expanduser(value)))
+        else:
+            digest.update(value)
+    return digest.hexdigest()
+
+
+def run_step(args, step, work_dir):
+    """Runs one plan step as its own ezboot process. Returns exit status."""
+    config = ConfigParser.RawConfigParser()
+    config.add_section(step.command)
+    for key, value in step.options.items():
+        # The child reads this with SafeConfigParser again.
+        config.set(step.command, key, value.replace('%', '%%'))
+    ini = os.path.join(work_dir, '%s.ini' % step.name)
+    with open(ini, 'w') as fp:
+        config.write(fp)
+
+    # run_plan has already waited for the device and forwarded the
+    # Marionette port.
+    cmd = [sys.executable, os.path.abspath(sys.argv[0]), '-c', ini,
+           '--work_dir', args.work_dir, '--adb_port', str(args.adb_port),
+           '--device_ready', step.command]
+    # Steps run unattended; anything that prompts fails instead of hanging.
+    with open(os.devnull) as devnull:
+        p = subprocess.Popen(cmd, stdin=devnull, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        for line in iter(p.stdout.readline, ''):
+            sys.stdout.write('[%s] %s' % (step.name, line))
+            sys.stdout.flush()
+        return p.wait()
+
+
+def prepare_plan_device(args, rebooting=False):
+    start = time.time()
+    while rebooting and not device_offline() and time.time() - start < 30:
+        # adb reboot returns before the device goes away.
+        time.sleep(0.2)
+    sh('adb wait-for-device')
+    sh('adb forward tcp:%s tcp:%s' % (args.adb_port, args.adb_port))
+
+
+class DeviceLock(object):
+    """Lets plan steps share the device unless one of them needs it alone."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.users = 0
+        self.exclusive = False
+
+    @contextmanager
+    def hold(self, exclusive=False):
+        with self.cond:
+            while self.exclusive or (exclusive and self.users):
+                self.cond.wait()
+            self.users += 1
+            self.exclusive = exclusive
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.users -= 1
+                self.exclusive = False
+                self.cond.notify_all()
+
+
+def run_plan(args):
+    plan = load_plan(args, args.plan)
+    serial = sh_output('adb get-serialno').strip()
+    cache_dir = os.path.join(args.work_dir, 'plans')
+    if not os.path.exists(cache_dir):
+        os.mkdir(cache_dir)
+    cache_file = os.path.join(cache_dir, '%s.json' % serial)
+    cache = {}
+    if os.path.exists(cache_file) and not args.force:
+        with open(cache_file) as fp:
+            cache = json.load(fp)
+
+    for step in plan.values():
+        step.fingerprint = step_fingerprint(step, plan)
+
+    device_lock = DeviceLock()
+    marionette_lock = threading.Lock()
+    finished = Queue.Queue()
+    work_dir = tempfile.mkdtemp()
+    prepare_plan_device(args)
+
+    def run_on_device(step):
+        rebooting = step.command in REBOOT_COMMANDS
+        with device_lock.hold(exclusive=rebooting):
+            if step.command in MARIONETTE_COMMANDS:
+                with marionette_lock:
+                    status = run_step(args, step, work_dir)
+            else:
+                status = run_step(args, step, work_dir)
+            if rebooting and status == 0:
+                # Wait for the device before anything else can use it.
+                prepare_plan_device(args, rebooting=True)
+        return status
+
+    def run(step):
+        try:
+            start = time.time()
+            if step.command in HOST_COMMANDS:
+                status = run_step(args, step, work_dir)
+            else:
+                status = run_on_device(step)
+            finished.put((step, status, time.time() - start))
+        except Exception, exc:
+            print '[%s] ** %s: %s' % (step.name, exc.__class__.__name__, exc)
+            finished.put((step, 1, 0))
+
+    done = set()
+    started = set()
+    failed = []
+    try:
+        while len(done) < len(plan):
+            if not failed:
+                for step in plan.values():
+                    if (step.name in started or
+                            not all(d in done for d in step.needs)):
+                        continue
+                    started.add(step.name)
+                    if cache.get(step.name) == step.fingerprint:
+                        print '[%s] unchanged, skipping' % step.name
+                        finished.put((step, None, 0))
+                        continue
+                    print '[%s] starting %s' % (step.name, step.command)
+                    thread = threading.Thread(target=run, args=(step,))
+                    thread.daemon = True
+                    thread.start()
+            if len(started) == len(done):
+                # Nothing left to wait for after a failure.
+                break
+
+            step, status, elapsed = finished.get()
+            done.add(step.name)
+            if status is None:
+                continue
+            if status != 0:
+                print '[%s] ** failed with exit status %s' % (step.name,
+                                                             status)
+                failed.append(step.name)
+                cache.pop(step.name, None)
+            else:
+                print '[%s] done in %.1fs' % (step.name, elapsed)
+                cache[step.name] = step.fingerprint
+            with open(cache_file, 'w') as fp:
+                json.dump(cache, fp)
+    finally:
+        shutil.rmtree(work_dir)
+
+    if failed:
+        print 'Failed steps: %s' % ', '.join(failed)
+        sys.exit(1)
+    print 'Plan complete'
+
+
 @contextmanager
 def pushd(newdir):
     wd = os.getcwd()
@@ -870,6 +4439,28 @@ def find_executable(name):
             return candidate
 
 
+def add_segments_argument(parser):
+    parser.add_argument('--segments', type=int, default=1,
+                        help='Download the build over this many parallel '
+                             'connections if the server supports it.')
+
+
+def add_bench_boot_argument(parser):
+    parser.add_argument('--bench_boot', action='store_true',
+                        help='Time each stage of the first boot after '
+                             'flashing and compare it with earlier builds.')
+
+
+def add_wifi_arguments(parser, default=None):
+    # Only pass a default when asked to so that the parser's own defaults,
+    # such as the ones from a config file section, still apply.
+    kw = {} if default is None else {'default': default}
+    parser.add_argument('--wifi_ssid', help='WiFi SSID to connect to', **kw)
+    parser.add_argument('--wifi_key', choices=['WPA-PSK', 'WEP'],
+                        help='WiFi key management.', **kw)
+    parser.add_argument('--wifi_pass', help='WiFi password', **kw)
+
+
 class Formatter(argparse.RawDescriptionHelpFormatter,
                 argparse.ArgumentDefaultsHelpFormatter):
     pass
@@ -909,11 +4500,15 @@ def main():
                           'empty')
     cmd.add_argument('--flash_device', default=None,
                      help='The device you want to flash. Example: unagi')
+    # Set by ezboot run for its steps.
+    cmd.add_argument('--device_ready', action='store_true',
+                     help=argparse.SUPPRESS)
     cmd.add_argument('--flash_device_id', default=None,
                      help='The device identifier as reported by adb devices -l (usb:<blah>)')
 
 
     sub = cmd.add_subparsers(help='sub-command help')
+    sections = {}
 
     def sub_parser(action, help='', **kw):
         if config:
@@ -926,16 +4521,27 @@ def main():
                         # Turn a multi-line value into a list.
                         cfg[key] = [a for a in val.strip().split('\n')]
                 cmd.set_defaults(**cfg)
+                sections[action] = cfg
             except ConfigParser.NoSectionError:
                 pass
         kw['formatter_class'] = Formatter
         return sub.add_parser(action, help=help, description=help, **kw)
 
     flash = sub_parser('flash', help='Download a build and flash it')
+    add_segments_argument(flash)
+    flash.add_argument('--delta', action='store_true',
+                       help='Only download the parts of the build that '
+                            'changed since the last one you flashed. '
+                            'The server must support Range requests.')
+    add_bench_boot_argument(flash)
+    # WiFi settings from the [setup] section are used here too.
+    add_wifi_arguments(flash, default=argparse.SUPPRESS)
     flash.set_defaults(func=flash_device)
 
     reflash = sub_parser('reflash', help='Re-flash the last build you '
                                          'downloaded')
+    add_bench_boot_argument(reflash)
+    add_wifi_arguments(reflash, default=argparse.SUPPRESS)
     reflash.set_defaults(func=flash_last_dl)
 
     desktop = sub_parser('desktop', help='Downloads and installs desktop b2g')
@@ -954,6 +4560,31 @@ def main():
     desktop.add_argument('--win32-url', help='32-bit Windows B2G URL',
                          default='%s/b2g-18.0.multi.win32.zip' % base_url)
 
+    bench_boot = sub_parser('bench-boot', help='Reboot the device several '
+                                               'times and time each stage '
+                                               'of booting.')
+    bench_boot.add_argument('-n', type=int, default=5,
+                            help='Number of times to reboot.')
+    bench_boot.add_argument('--baseline', metavar='REVISION',
+                            help='Compare against the build with this gecko '
+                                 'or gaia revision instead of the last '
+                                 'build benchmarked.')
+    bench_boot.set_defaults(func=do_bench_boot)
+
+    bench_fps = sub_parser('bench-fps', help='Measure the frame rate of '
+                                             'scrolling in an app.')
+    bench_fps.add_argument('--app', required=True,
+                           help='Name of the app to scroll, like Settings.')
+    bench_fps.add_argument('--duration', type=int, default=5,
+                           help='Seconds to scroll for.')
+    bench_fps.add_argument('--scroll_step', type=int, default=20,
+                           help='Pixels to scroll on each frame.')
+    bench_fps.add_argument('--baseline', metavar='REVISION',
+                           help='Compare against the build with this gecko '
+                                'or gaia revision instead of the last '
+                                'build benchmarked.')
+    bench_fps.set_defaults(func=do_bench_fps)
+
     bind = sub_parser('bind', help='Bind a hostname on your mobile device '
                                    'to your local server')
     bind.set_defaults(func=do_bind)
@@ -963,15 +4594,15 @@ def main():
                                         'will be discovered.')
     bind.add_argument('--bind_int', help='Network interface to guess an IP from',
                       default=None)
+    bind.add_argument('--probe_timeout', type=int, default=3,
+                      help='Seconds to wait for the device to reach each '
+                           'IP when guessing which one to bind to.')
     bind.add_argument('--show_net',
                       help='Show network info but do not bind anything.',
                       action='store_true')
 
     setup = sub_parser('setup', help='Set up a flashed device for usage')
-    setup.add_argument('--wifi_ssid', help='WiFi SSID to connect to')
-    setup.add_argument('--wifi_key', choices=['WPA-PSK', 'WEP'],
-                       help='WiFi key management.')
-    setup.add_argument('--wifi_pass', help='WiFi password')
+    add_wifi_arguments(setup)
     setup.add_argument('--apps', nargs='*', metavar='MANIFEST_URL',
                        help='App manifest URLs to install on the device '
                             'at boot.')
@@ -981,8 +4612,36 @@ def main():
                        help='Custom JS prefs file to copy into '
                             '/data/local/user.js. Exising user.js is '
                             'not preserved.')
+    setup.add_argument('--proxy', metavar='HOST:PORT',
+                       help='Send device HTTP traffic through this proxy, '
+                            'such as the one from ezboot proxy.')
+    setup.add_argument('--proxy_ca', metavar='PEM_FILE',
+                       help='CA certificate of the proxy to trust on the '
+                            'device. Default: the one ezboot proxy '
+                            '--intercept_https created in the work dir.')
     setup.set_defaults(func=set_up_device)
 
+    memory = sub_parser('memory', help='Collect about:memory reports from '
+                                       'all b2g processes and compare them '
+                                       'with an earlier build.')
+    memory.add_argument('--baseline', metavar='REVISION',
+                        help='Compare against the build with this gecko or '
+                             'gaia revision instead of the last build '
+                             'measured.')
+    memory.add_argument('--diff', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='Compare two saved runs, by run name or '
+                             'revision, without collecting a new one.')
+    memory.add_argument('--top', type=int, default=20,
+                        help='Number of the largest growths to show.')
+    memory.add_argument('--minimize', action='store_true',
+                        help='Minimize memory usage before reporting.')
+    memory.add_argument('--report_timeout', type=int, default=60,
+                        help='Seconds to wait for all processes to report.')
+    memory.add_argument('--keep_reports', action='store_true',
+                        help='Keep the raw gzipped reports, which can be '
+                             'loaded in about:memory.')
+    memory.set_defaults(func=do_memory)
+
     mkt_certs = sub_parser('mkt_certs', help='Setup certs for packaged '
                                              'marketplace for testing.')
     mkt_certs.add_argument('--certs_path',
@@ -991,6 +4650,12 @@ def main():
     # we can add more options like this whenever we want
     mkt_certs.add_argument('--dev', help='Setup certs for marketplace dev.',
                            dest='env', action='append_const', const='dev')
+    mkt_certs.add_argument('--device_ids', nargs='*', metavar='DEVICE_ID',
+                           help='Install certs on all of these devices at '
+                                'once instead of just flash_device_id.')
+    mkt_certs.add_argument('--certs_max_age', type=int, default=24,
+                           help='Hours before pulling marketplace-certs '
+                                'from GitHub again.')
     mkt_certs.set_defaults(func=setup_certs)
 
     install_mp = sub_parser('install_mkt', help='Install marketplace app.')
@@ -1015,8 +4680,62 @@ def main():
     dl = sub_parser('dl', help='Download a build to a custom location')
     dl.add_argument('--location', help='Directory to download to',
                     default=os.path.expanduser('~/Downloads'))
+    add_segments_argument(dl)
     dl.set_defaults(func=download_and_save_build)
 
+    prefetch = sub_parser('prefetch', help='Download and unpack new builds in '
+                                           'the background so flash can '
+                                           'use them right away.')
+    prefetch.add_argument('--at', metavar='HH:MM',
+                          help='Keep running and prefetch every day at this '
+                               'time.')
+    prefetch.add_argument('--interval', type=int, metavar='MINUTES',
+                          help='Keep running and check for new builds this '
+                               'often.')
+    prefetch.add_argument('--prefetch_urls', nargs='*', metavar='URL',
+                          help='More build URLs to prefetch besides '
+                               '--flash_url or --flash_device.')
+    prefetch.add_argument('--max_rate', type=int, metavar='KB_PER_SEC',
+                          help='Limit the download rate.')
+    prefetch.add_argument('--keep', type=int, default=2,
+                          help='Number of builds to keep per URL.')
+    prefetch.set_defaults(func=do_prefetch)
+
+    serve = sub_parser('serve', help='Run a local mirror of the build server '
+                                     'so each build is only downloaded once.')
+    serve.add_argument('--mirror_port', type=int, default=8000,
+                       help='Port to serve builds on.')
+    serve.add_argument('--mirror_bind', default='127.0.0.1',
+                       metavar='ADDRESS',
+                       help='Address to listen on. Use the IP of your '
+                            'network interface (or 0.0.0.0) to share '
+                            'the mirror with other hosts.')
+    serve.add_argument('--mirror_upstream',
+                       default='https://pvtbuilds.mozilla.org',
+                       help='Server to mirror builds from.')
+    serve.add_argument('--mirror_max_age', type=int, default=300,
+                       help='Seconds before checking upstream for a newer '
+                            'build again.')
+    serve.set_defaults(func=serve_mirror)
+
+    proxy = sub_parser('proxy', help='Run a caching HTTP proxy for devices '
+                                     'so app downloads are shared.')
+    proxy.add_argument('--proxy_port', type=int, default=8080,
+                       help='Port to listen on.')
+    proxy.add_argument('--proxy_bind', required=True, metavar='ADDRESS',
+                       help='Address to listen on, such as the IP of the '
+                            'network interface your devices are on. Use '
+                            '0.0.0.0 for all of them.')
+    proxy.add_argument('--proxy_cache_size', type=int, default=2048,
+                       help='Maximum size of the cache in MB.')
+    proxy.add_argument('--intercept_https', action='store_true',
+                       help='Decrypt HTTPS with a local CA so it can be '
+                            'cached too. Devices need the CA installed, '
+                            'which setup --proxy does.')
+    proxy.add_argument('--verbose', action='store_true',
+                       help='Log every request.')
+    proxy.set_defaults(func=run_proxy)
+
     http = sub_parser('http',
                       help='Restart the device with HTTP logging '
                            'enabled.')
@@ -1027,6 +4746,24 @@ def main():
                                    'on your device.')
     info.set_defaults(func=show_build_info)
 
+    logcat = sub_parser('logcat', help='Capture device logs to disk and '
+                                       'search them.')
+    logcat.add_argument('--capture', action='store_true',
+                        help='Record logcat into compressed segments until '
+                             'interrupted, following the device across '
+                             'reboots.')
+    logcat.add_argument('--query', nargs='*', metavar='FIELD=VALUE',
+                        help='Print captured lines that match all of these, '
+                             'e.g. tag=Gecko pid=123 level=W text=error.')
+    logcat.add_argument('--since', metavar='DURATION',
+                        help='Only query lines from this long ago, '
+                             'e.g. 30s, 10m, 2h or 1d.')
+    logcat.add_argument('--segment_size', type=int, default=16,
+                        help='Megabytes of log text in each segment.')
+    logcat.add_argument('--keep_segments', type=int, default=200,
+                        help='Delete the oldest segments beyond this many.')
+    logcat.set_defaults(func=do_logcat)
+
     login = sub_parser('login', help='Enter Persona login username/password. '
                                      'You must have a login prompt open '
                                      'on your device.')
@@ -1036,9 +4773,66 @@ def main():
                       help='Kill all running apps.')
     kill.set_defaults(func=kill_all_apps)
 
+    snapshot = sub_parser('snapshot', help='Save the apps, settings, '
+                                           'certs and prefs on a set up '
+                                           'device so they can be restored '
+                                           'after flashing.')
+    snapshot.add_argument('name', help='Name for the snapshot.')
+    snapshot.set_defaults(func=do_snapshot)
+
+    restore = sub_parser('restore', help='Restore a snapshot onto one or '
+                                         'more devices.')
+    restore.add_argument('name', help='Name of the snapshot.')
+    restore.add_argument('--device_ids', nargs='*', metavar='DEVICE_ID',
+                         help='Restore onto all of these devices at once '
+                              'instead of the only connected one.')
+    restore.set_defaults(func=do_restore)
+
+    sync = sub_parser('sync', help='Push only the files that changed in a '
+                                   'local directory to the device.')
+    sync.add_argument('local_dir', help='Local directory, such as a Gaia app.')
+    sync.add_argument('device_path',
+                      help='Directory on the device to keep in sync.')
+    sync.add_argument('--restart_app', metavar='APP_NAME',
+                      help='Restart this app after syncing.')
+    sync.set_defaults(func=do_sync)
+
+    run = sub_parser('run', help='Run the steps in a provisioning plan, '
+                                 'in parallel where possible.')
+    run.add_argument('plan', help='Path to a plan .ini file.')
+    run.add_argument('--force', action='store_true',
+                     help='Run every step even if its inputs have not '
+                          'changed since the last run on this device.')
+    run.set_defaults(func=run_plan)
+
     recss = sub_parser('recss', help='Reload all stylesheets.')
+    recss.add_argument('--watch', metavar='CSS_DIR',
+                       help='Keep running and reload only the stylesheets '
+                            'that change in this local directory.')
+    recss.add_argument('--debounce', type=int, default=100,
+                       help='Milliseconds to wait for a burst of saves to '
+                            'settle before reloading.')
     recss.set_defaults(func=do_recss)
 
+    # Since Python 2.7.9 the defaults of a sub command override the ones
+    # set above, so each sub command also gets the options of its section
+    # that it defines itself. This has to happen after its arguments are
+    # added or their defaults would win. Options of the main parser are
+    # left alone so they can still be overridden on the command line.
+    for action, parser in sub.choices.items():
+        section = sections.get(action, {})
+        defaults = {}
+        for option in parser._actions:
+            if option.dest not in section:
+                continue
+            if isinstance(option, (argparse._StoreTrueAction,
+                                   argparse._StoreFalseAction)):
+                defaults[option.dest] = config.getboolean(action,
+                                                          option.dest)
+            else:
+                defaults[option.dest] = section[option.dest]
+        parser.set_defaults(**defaults)
+
     args = cmd.parse_args(remaining_argv)
 
     if config:
@@ -1069,7 +4863,7 @@ http://developer.android.com/sdk/index.html
     # This should cut down on any sad face errors that
     # might happen after, oh, say, downloading 180MB. But allow commands
     # which don't require adb to opt out.
-    if getattr(args.func, 'requires_adb', True):
+    if getattr(args.func, 'requires_adb', True) and not args.device_ready:
         print 'Waiting for your device (is it plugged in?)'
         sh('adb wait-for-device')
         print 'found it'